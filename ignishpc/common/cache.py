@@ -0,0 +1,67 @@
+import os
+import time
+import fcntl
+import shutil
+import contextlib
+
+
+@contextlib.contextmanager
+def lock(path, blocking=True):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def touch(path):
+    os.utime(path, (time.time(), time.time()))
+
+
+def size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file = os.path.join(root, name)
+            if not os.path.islink(file):
+                total += os.path.getsize(file)
+    return total
+
+
+def entries(folder, suffix=""):
+    if not os.path.isdir(folder):
+        return []
+    result = list()
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name.endswith(suffix) and not name.endswith(".lock"):
+            result.append((path, os.path.getmtime(path), size(path)))
+    return sorted(result, key=lambda entry: entry[1], reverse=True)
+
+
+# Remove the least recently used entries until the folder is under the limit, locked entries are kept.
+def evict(folder, limit, suffix=""):
+    cached = entries(folder, suffix)
+    total = sum(entry[2] for entry in cached)
+    removed = list()
+    for path, used, entry_size in reversed(cached):
+        if total <= limit:
+            break
+        with lock(path + ".lock", blocking=False) as acquired:
+            if not acquired:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        total -= entry_size
+        removed.append((path, used, entry_size))
+    return removed
@@ -11,6 +11,7 @@ from ruamel.yaml.comments import CommentedBase
 
 USER_CONFIG = os.getenv("IGNIS_USER_CONFIG", default=os.path.expanduser("~/.ignis/etc/ignis.yaml"))
 SYSTEM_CONFIG = os.getenv("IGNIS_SYSTEM_CONFIG", default="/etc/ignis/ignis.yaml")
+CACHE_DIR = os.getenv("IGNIS_CACHE", default=os.path.expanduser("~/.ignis/cache"))
 yaml = YAML()
 _KEY_CRYPTO = "ignis.crypto.secret"
 props = yaml.load("""
@@ -27,13 +28,22 @@ ignis:
       source: "${HOME}/.ignis/images"
       default: "ignishpc.sif"
       network: "default"
+      cache: "20GB"
     apptainer:
       source: "${HOME}/.ignis/images"
       default: "ignishpc.sif"
       network: "default"
+      cache: "20GB"
     hostpipe: false
     writable: false
     #provider: ""
+  images:
+    cache:
+      sources: "10GB"
+    gc:
+      last: 3
+      days: 30
+      size: ""
 """)
 
 
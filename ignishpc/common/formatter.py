@@ -48,3 +48,27 @@ def time_t(x):
     if not re.match(r"([0-9]+-)?([0-9]+:)?[0-9]+:[0-9]+", x):  # [[dd-]hh:]mm:ss
         raise argparse.ArgumentTypeError("invalid time format")
     return x
+
+
+def parse_size(x):
+    match = re.fullmatch(r"([0-9]+(\.[0-9]+)?) *([kKmMgGtT]?)i?[bB]?", x.strip())
+    if not match:
+        raise ValueError("invalid size format: " + x)
+    return int(float(match.group(1)) * 1024 ** " KMGT".index(match.group(3).upper() or " "))
+
+
+def positive_t(x):
+    try:
+        value = int(x)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: '" + x + "'")
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: " + x)
+    return value
+
+
+def size_t(x):
+    try:
+        return parse_size(x)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
@@ -0,0 +1,97 @@
+import os
+import re
+import platform
+import subprocess
+
+import requests
+
+from ignishpc.common import cache
+from ignishpc.common import configuration
+from ignishpc.common.formatter import parse_size
+
+_MANIFESTS = ", ".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
+_CHALLENGE = re.compile(r'(\w+)="([^"]*)"')
+
+
+def parse_reference(ref):
+    name = ref[len("docker://"):] if ref.startswith("docker://") else ref
+    name, _, digest = name.partition("@")
+    tag = "latest"
+    if ":" in name.split("/")[-1]:
+        name, tag = name.rsplit(":", 1)
+    fields = name.split("/")
+    if len(fields) > 1 and ("." in fields[0] or ":" in fields[0] or fields[0] == "localhost"):
+        registry, repository = fields[0], "/".join(fields[1:])
+    else:
+        registry, repository = "registry-1.docker.io", name
+    if registry == "registry-1.docker.io" and "/" not in repository:
+        repository = "library/" + repository
+    return registry, repository, digest or tag
+
+
+# Manifest digest of a docker reference using the registry HTTP API, anonymous tokens are requested if needed
+def digest(ref, timeout=10):
+    registry, repository, reference = parse_reference(ref)
+    if reference.startswith("sha256:"):
+        return reference
+    url = "https://" + registry + "/v2/" + repository + "/manifests/" + reference
+    headers = {"Accept": _MANIFESTS}
+    response = requests.head(url, headers=headers, timeout=timeout)
+    if response.status_code == 401 and "Bearer" in response.headers.get("WWW-Authenticate", ""):
+        challenge = dict(_CHALLENGE.findall(response.headers["WWW-Authenticate"]))
+        token = requests.get(challenge["realm"], timeout=timeout, params={
+            "service": challenge.get("service", registry),
+            "scope": challenge.get("scope", "repository:" + repository + ":pull")
+        }).json()
+        token = (token.get("token") or token.get("access_token")) if isinstance(token, dict) else None
+        if not token:
+            raise ValueError("registry " + registry + " returned no token")
+        headers["Authorization"] = "Bearer " + token
+        response = requests.head(url, headers=headers, timeout=timeout)
+    response.raise_for_status()
+    return response.headers["Docker-Content-Digest"]
+
+
+def cache_folder(provider):
+    source = configuration.get_string(f"ignis.container.{provider}.source")
+    return os.path.join(os.path.expanduser(os.path.expandvars(source)), "cache")
+
+
+def cache_limit(provider):
+    return parse_size(configuration.get_string(f"ignis.container.{provider}.cache", "20GB"))
+
+
+# Local sif of a docker reference, it is converted only if the digest is not in the cache
+def resolve(ref, provider):
+    try:
+        image_digest = digest(ref)
+    except (requests.RequestException, KeyError, ValueError):
+        return ref  # registry not available, the runtime pulls the image
+    folder = cache_folder(provider)
+    path = os.path.join(folder, image_digest.replace(":", "-") + "-" + platform.machine() + ".sif")
+    try:
+        with cache.lock(path + ".lock"):
+            if os.path.exists(path):
+                cache.touch(path)
+                return path
+            name = ref[len("docker://"):].partition("@")[0]
+            if ":" in name.split("/")[-1]:
+                name = name.rsplit(":", 1)[0]
+            tmp = path + "." + str(os.getpid())
+            print("converting " + ref + " to " + path, flush=True)
+            result = subprocess.run([provider, "pull", "--force", tmp, "docker://" + name + "@" + image_digest])
+            if result.returncode != 0:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                return ref
+            os.replace(tmp, path)
+            # the new image is locked, it is never evicted
+            cache.evict(folder, cache_limit(provider), ".sif")
+    except OSError:
+        return ref  # cache not writable
+    return path
@@ -0,0 +1,30 @@
+import os
+import json
+import time
+
+from ignishpc.common import cache
+from ignishpc.common import configuration
+
+USAGE_FILE = os.path.join(configuration.CACHE_DIR, "image-usage.json")
+
+
+def load():
+    try:
+        with open(USAGE_FILE) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+# Record that a job used the image now, image retention keeps recently used images
+def record(image):
+    try:
+        with cache.lock(USAGE_FILE + ".lock"):
+            used = load()
+            used[image] = int(time.time())
+            tmp = USAGE_FILE + "." + str(os.getpid())
+            with open(tmp, "w") as file:
+                json.dump(used, file)
+            os.replace(tmp, USAGE_FILE)
+    except OSError:
+        pass  # a read-only home must not stop the job
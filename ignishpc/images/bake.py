@@ -0,0 +1,42 @@
+import re
+import json
+
+
+def _target_name(name):
+    return re.sub(r"[^A-Za-z0-9_-]", "_", name)
+
+
+def _target(image, context, dockerfile, args, labels, platforms, parents, cache_to=None, cache_from=None):
+    target = {
+        "context": context,
+        "dockerfile": dockerfile,
+        "args": args,
+        "labels": labels,
+        "tags": [image],
+        "contexts": {ref: "target:" + _target_name(parent) for ref, parent in parents.items()},
+    }
+    if platforms is not None:
+        target["platforms"] = platforms.split(",")
+    if cache_to is not None:
+        target["cache-to"] = [cache_to]
+    if cache_from is not None:
+        target["cache-from"] = [cache_from]
+    else:
+        target["no-cache"] = True
+    return target
+
+
+def _plan(targets):
+    return {
+        "group": {
+            "default": {
+                "targets": [_target_name(name) for name in targets]
+            }
+        },
+        "target": {_target_name(name): target for name, target in targets.items()}
+    }
+
+
+def _write(plan, path):
+    with open(path, "w") as file:
+        json.dump(plan, file, indent=2)
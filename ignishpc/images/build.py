@@ -1,18 +1,46 @@
 import os
 import re
+import hashlib
+import uuid
+import functools
 import tempfile
 import shutil
 import fnmatch
-import shlex
 import textwrap
 import subprocess
+import concurrent.futures
+import time
+from contextlib import nullcontext
 from collections import namedtuple
 
-import git
 import docker
 import docker.errors
+import docker.utils
 
 from ignishpc.common import configuration
+from ignishpc.common.formatter import parse_size
+from ignishpc.images import bake
+from ignishpc.images import changes
+from ignishpc.images import context
+from ignishpc.images import farm
+from ignishpc.images import fetch
+from ignishpc.images import history
+from ignishpc.images import progress
+from ignishpc.images import report
+from ignishpc.images import scheduler
+from ignishpc.images import state
+from ignishpc.images.dockerfile import _parse_dockerfile
+
+
+# Remove ANSI color codes from the logs.
+_ANSI = re.compile('\033\\[([0-9]+)(;[0-9]+)*m')
+_STEP = re.compile(r"^Step ([0-9]+/[0-9]+) : ")
+_BUILDX_STEP = re.compile(r"^#[0-9]+ \[.*?([0-9]+/[0-9]+)\]")
+_BUILT = re.compile(r"(^Successfully built |sha256:)([0-9a-f]+)$")
+_MANIFEST_ERROR = re.compile(".*manifest for (.*) not found.*")
+
+
+_Plan = namedtuple("Plan", "local path args selection hash")
 
 
 def _replace_all(s, vars):
@@ -32,78 +60,99 @@ def _folder_gen(wd):
         i += 1
 
 
-def _ignore_hidden(path, names):
-    hidden = []
-    for name in names:
-        if name.startswith("."):
-            hidden.append(name)
-    return set(hidden)
+def _step_timings(file, steps):
+    if len(steps) > 0:
+        file.write("\nStep timings:\n")
+        for step, elapsed in steps:
+            file.write("  " + progress._time_format(elapsed).rjust(10) + "  " + step[:100] + "\n")
 
 
-def _dump_log(buildlog, path, msg=None):
-    # Remove ANSI color codes from the string.
-    strip = re.compile('\033\\[([0-9]+)(;[0-9]+)*m')
-    with open(path, "w") as file:
-        for raw in buildlog:
-            if isinstance(raw, dict) and 'stream' in raw:
-                file.write(re.sub(strip, '', raw['stream']))
-            elif isinstance(raw, str):
-                file.write(re.sub(strip, '', raw))
-        if msg is not None:
-            file.write(msg)
+def _input_hash(dockerfile, build_args, context_digest, parents, platform=None):
+    digest = hashlib.sha256()
+    with open(dockerfile.path, "rb") as file:
+        digest.update(file.read())
+    for key in sorted(build_args):
+        if key != "BUILD_CORES":  # only changes the build speed
+            digest.update(("\0" + key + "=" + build_args[key]).encode("utf-8"))
+    digest.update(context_digest.encode("utf-8"))
+    for parent in sorted(parents):
+        digest.update(parent.encode("utf-8"))
+    if platform is not None:
+        digest.update(("\0platform=" + platform).encode("utf-8"))
+    return digest.hexdigest()
 
 
-def _parse_dockerfile(folder, subpath, name):
-    lines = list()
-    path = os.path.join(folder, subpath, "Dockerfile")
-    with open(path) as file:
-        newline = True
-        for line in file:
-            scape = len(line) > 1 and line[-2] == '\\'
-            if scape:
-                line = line[:-2]
-            line = line.strip()
+# Identity of a parent image that is not built in this run, None if it can't be resolved
+def _parent_digest(ref):
+    try:
+        client = docker.from_env()
+        try:
+            return client.images.get(ref).id
+        except docker.errors.ImageNotFound:
+            return client.images.get_registry_data(ref).id
+    except docker.errors.DockerException:
+        return None
 
-            if newline:
-                lines.append(line)
-            else:
-                lines[-1] += " " + line
-            newline = not scape
-    requires = set()
-    args = set()
-    labels = {}
-    for line in lines:
-        if any(line.upper().startswith(prefix) for prefix in ["FROM", "LABEL", "ARG", "COPY"]):
-            fields = shlex.split(line, posix=False)[1:]
-            try:
-                if line[0].upper() == "F":
-                    if fields[0].startswith("--"):
-                        fields = fields[1:]
-                    requires.add(fields[0])
-                elif line[0].upper() == "L":
-                    for label in fields:
-                        key, value = label.split("=")
-                        labels[key] = value[1:-1]
-                elif line[0].upper() == "A":
-                    tag = fields[0] if '=' not in fields[0] else fields[0].split("=")[0]
-                    args.add(tag)
-                else:
-                    for field in fields:
-                        if field.startswith("--from"):
-                            requires.add(fields[0].split("=")[1])
-                            break
-            except Exception as ex:
-                print("warn: " + line + " is ignored by parser, " + str(ex))
 
-    return namedtuple("Dockerfile", "folder, path, subpath, name requires args labels"
-                      )(folder, path, subpath, name, requires, args, labels)
+def _cached(name, input_hash, client=None):
+    try:
+        image = (client or docker.from_env()).images.get(name)
+    except docker.errors.DockerException:
+        return False
+    return image.labels.get("ignis.build.hash") == input_hash
 
 
-def _create_dockerfile(path, name, cores, core_libs, build_args):
+def _image_info(name, client=None):
+    try:
+        image = (client or docker.from_env()).images.get(name)
+    except docker.errors.DockerException:
+        return None, None, None
+    return image.id, image.attrs.get("Size"), len(image.attrs.get("RootFS", {}).get("Layers", []))
+
+
+# Paths outside the Dockerfiles folder used by the Dockerfiles of a source, None if they can't be resolved.
+def _referenced(src, build_args):
+    folder = os.path.join(src, "Dockerfiles")
+    paths = list()
+    for path, _, files in os.walk(folder):
+        if "Dockerfile" in files:
+            dock_dir = os.path.relpath(path, src) + "/"
+            dockerfile = _parse_dockerfile(folder, os.path.relpath(path, folder), "",
+                                           dict(build_args, DOCK_DIR=dock_dir, RELPATH=dock_dir))
+            if dockerfile.labels.get("ignis.build.context", False):
+                continue
+            for source in dockerfile.sources:
+                source = _replace_all(source, build_args)
+                if "$" in source:
+                    return None
+                if not source.lstrip("/").startswith("Dockerfiles/"):
+                    paths.append(source)
+    return paths
+
+
+# Cores that change less often first, so their layers are reused by more builds. base is always first.
+def _core_order(cores, durations):
+    rates = {core: history._change_rate(durations, core + "-builder") for core in cores}
+    return sorted(cores, key=lambda core: (core != "base", rates[core]))
+
+
+# Cores that change more often than the average, they are installed in an upper layer
+def _volatile_cores(cores, durations):
+    rates = {core: history._change_rate(durations, core + "-builder") for core in cores if core != "base"}
+    if len(rates) == 0:
+        return set()
+    mean = sum(rates.values()) / len(rates)
+    return {core for core, rate in rates.items() if rate > mean}
+
+
+def _create_dockerfile(path, name, cores, core_libs, build_args, compact=False, volatile=()):
     header = """
     ARG REGISTRY=""
     ARG NAMESPACE="ignishpc/"
     ARG TAG=""
+    """
+
+    template = """
     FROM ${REGISTRY}${NAMESPACE}template${TAG}
     """
 
@@ -115,11 +164,52 @@ def _create_dockerfile(path, name, cores, core_libs, build_args):
 
     lib_builder = builder.replace("-builder", "-lib")
 
-    dockerfile = ""
-    for core in cores:
-        dockerfile += builder.replace("${CORE}", core)
-        for lib in core_libs.get(core, []):
-            dockerfile += lib_builder.replace("${CORE}", lib)
+    # every builder is an independent stage, BuildKit resolves them in parallel
+    stage = """
+    FROM ${REGISTRY}${NAMESPACE}${IMAGE}${TAG} AS ${STAGE}
+    """
+
+    # the builders of a tier are merged in a stage and installed in a single layer
+    tier = """
+    FROM ${REGISTRY}${NAMESPACE}template${TAG} AS ${TIER}
+    """
+
+    tier_copy = """
+    COPY --from=${STAGE} ${IGNIS_HOME} ${IGNIS_HOME}
+    """
+
+    install = """
+    COPY --from=${TIER} ${IGNIS_HOME} ${IGNIS_HOME}
+    RUN for installer in ${INSTALLERS}; do \\
+            ${IGNIS_HOME}/bin/ignis-$installer-install.sh && \\
+            rm -f ${IGNIS_HOME}/bin/ignis-$installer-install.sh || exit 1; \\
+        done
+    """
+
+    if compact:
+        # stable cores in the lower tier, a change in a volatile core only rebuilds the upper one
+        tiers = [[core for core in cores if core not in volatile], [core for core in cores if core in volatile]]
+        stages = ""
+        dockerfile = template
+        for i, tier_cores in enumerate([tier_cores for tier_cores in tiers if len(tier_cores) > 0]):
+            tier_name = "tier" + str(i)
+            merge = tier.replace("${TIER}", tier_name)
+            installers = list()
+            for core in tier_cores:
+                for image, installer in [(core + "-builder", core)] + \
+                                        [(lib + "-lib", lib) for lib in core_libs.get(core, [])]:
+                    stages += stage.replace("${IMAGE}", image).replace("${STAGE}", "stage-" + installer)
+                    merge += tier_copy.replace("${STAGE}", "stage-" + installer)
+                    installers.append(installer)
+            stages += merge
+            dockerfile += install.replace("${TIER}", tier_name).replace("${INSTALLERS}", " ".join(installers))
+        dockerfile = stages + dockerfile
+    else:
+        dockerfile = template
+        for core in cores:
+            dockerfile += builder.replace("${CORE}", core)
+            for lib in core_libs.get(core, []):
+                dockerfile += lib_builder.replace("${CORE}", lib)
     for arg, value in build_args.items():
         dockerfile = dockerfile.replace("${" + arg + "}", value)
 
@@ -128,41 +218,120 @@ def _create_dockerfile(path, name, cores, core_libs, build_args):
     os.makedirs(folder)
     with open(os.path.join(folder, "Dockerfile"), "w") as file:
         file.write(dockerfile)
-    return _parse_dockerfile(folder, "", name)
-
-
-def _build(name, path, dockerfile, build_args, labels, arch, logfile, debug):
-    try:
-        client = docker.from_env()
-
-        image, buildlog = client.images.build(
-            path=path,
-            tag=name,
-            dockerfile=dockerfile,
-            labels=labels,
-            platform=arch,
-            buildargs=build_args
-        )
-        if debug:
-            _dump_log(buildlog, logfile)
-    except docker.errors.BuildError as ex:
-        manifest_error = re.compile(".*manifest for (.*) not found.*")
-        msg = ex.msg
-        if isinstance(msg, dict):
-            if "message" in msg:
-                msg = msg["message"]
-            else:
-                msg = str(msg)
-        result = manifest_error.search(msg)
-        if result:
-            msg += "\n" + result.group(1) + " required, use -s/--sources to add the Dockerfile"
-        _dump_log(ex.build_log, logfile, msg=msg)
-        return False
+    return _parse_dockerfile(folder, "", name, build_args)
+
+
+def _build(name, path, dockerfile, build_args, labels, arch, logfile, debug, context=None, status=None,
+           limits=None, client=None):
+    client = client or docker.from_env()
+    kwargs = dict(tag=name, labels=labels, platform=arch, buildargs=build_args, container_limits=limits,
+                  decode=True)
+    image_id = None
+    msg = None
+    steps = list()
+    start = time.time()
+    with open(logfile, "w") as file, (open(context, "rb") if context is not None else nullcontext()) as fileobj:
+        if fileobj is not None:
+            stream = client.api.build(fileobj=fileobj, custom_context=True,
+                                      dockerfile=os.path.relpath(dockerfile, path), **kwargs)
+        else:
+            stream = client.api.build(path=path, dockerfile=dockerfile, **kwargs)
+
+        for chunk in stream:
+            if "error" in chunk:
+                msg = chunk["error"] if isinstance(chunk["error"], str) else str(chunk["error"])
+                break
+            if "aux" in chunk and "ID" in chunk["aux"]:
+                image_id = chunk["aux"]["ID"]
+            if "stream" in chunk:
+                line = _ANSI.sub("", chunk["stream"])
+                file.write(line)
+                file.flush()
+                step = _STEP.match(line)
+                if step:
+                    now = time.time()
+                    if len(steps) > 0:
+                        steps[-1][1] = now - start
+                    steps.append([line.strip(), None])
+                    start = now
+                    if status is not None:
+                        status.step(name, "step " + step.group(1))
+                built = _BUILT.search(line.strip())
+                if built:
+                    image_id = built.group(2)
+        if len(steps) > 0:
+            steps[-1][1] = time.time() - start
+
+        if msg is None and image_id is None:
+            msg = "build finished without an image"
+        if msg is not None:
+            result = _MANIFEST_ERROR.search(msg)
+            if result:
+                msg += "\n" + result.group(1) + " required, use -s/--sources to add the Dockerfile"
+            file.write(msg)
+        _step_timings(file, steps)
 
-    return True
+    if msg is None and not debug:
+        os.remove(logfile)
+    return msg is None
 
 
-def _buildx(name, path, dockerfile, build_args, labels, arch, logfile, debug):
+# Reuse an unchanged image, the new tag is created in the registry when buildx is used
+def _retag(source, name, buildx=False, client=None):
+    if source == name and buildx:
+        return True
+    if buildx:
+        return subprocess.run(["docker", "buildx", "imagetools", "create", "--tag", name, source],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    client = client or docker.from_env()
+    try:
+        try:
+            image = client.images.get(source)
+        except docker.errors.ImageNotFound:
+            image = client.images.pull(source)
+        repository, tag = docker.utils.parse_repository_tag(name)
+        return image.tag(repository, tag)
+    except docker.errors.DockerException:
+        return False  # not available, the image is built
+
+
+# Tag of the registry that identifies an image by its inputs
+def _hash_tag(name, input_hash):
+    repository, _ = docker.utils.parse_repository_tag(name)
+    return repository + ":build-" + input_hash
+
+
+# With buildx the tag is created in the registry, otherwise the image is pulled and tagged in the local daemon
+def _registry_pull(source, name, input_hash, buildx=False, client=None):
+    if buildx:
+        return _retag(source, name, True)
+    client = client or docker.from_env()
+    try:
+        client.images.get_registry_data(source)
+        repository, tag = docker.utils.parse_repository_tag(source)
+        image = client.images.pull(repository, tag=tag)
+        if image.labels.get("ignis.build.hash") != input_hash:
+            return False
+        repository, tag = docker.utils.parse_repository_tag(name)
+        return image.tag(repository, tag)
+    except docker.errors.DockerException:
+        return False  # not published, the image is built
+
+
+def _registry_push(name, target, buildx=False, client=None):
+    if buildx:
+        if not _retag(name, target, True):
+            raise RuntimeError(target + " push error")
+        return
+    client = client or docker.from_env()
+    repository, tag = docker.utils.parse_repository_tag(target)
+    client.images.get(name).tag(repository, tag)
+    for chunk in client.images.push(repository, tag=tag, stream=True, decode=True):
+        if "error" in chunk:
+            raise RuntimeError(target + " push error: " + str(chunk["error"]))
+
+
+def _buildx_builder():
     result = subprocess.run(["docker", "buildx", "version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     if result.returncode != 0:
         raise RuntimeError(result.stdout.decode("utf-8"))
@@ -174,32 +343,116 @@ def _buildx(name, path, dockerfile, build_args, labels, arch, logfile, debug):
         if result.returncode != 0:
             raise RuntimeError(result.stdout.decode("utf-8"))
 
-    raw_build_args = sum([["--build-arg", arg + "=" + val] for arg, val in build_args.items()], [])
-    raw_labels = sum([["--label", lab + "=" + val] for lab, val in labels.items()], [])
 
-    result = subprocess.run(["docker", "buildx", "build",
-                             "--builder", "ignishpc",
-                             "--file", dockerfile,
-                             "--no-cache",
-                             "--platform", arch,
-                             "--progress", "plain",
-                             "--push",
-                             "--tag", name,
-                             "."] + raw_build_args + raw_labels,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=path)
+def _buildx_cache(spec, name, export):
+    if spec is None:
+        return None
+    repo, tag = name, ""
+    if ":" in name.rsplit("/", 1)[-1]:
+        repo, tag = name.rsplit(":", 1)
+        tag = ":" + tag
+    if spec == "registry":
+        spec = "type=registry,ref=" + repo + "-buildcache" + tag
+    elif spec.startswith("local:"):
+        folder = os.path.join(os.path.abspath(spec[len("local:"):]), repo.rsplit("/", 1)[-1] + tag.replace(":", "-"))
+        spec = "type=local," + ("dest=" if export else "src=") + folder
+    if export and "mode=" not in spec:
+        spec += ",mode=max"
+    return spec
+
+
+def _buildx_run(cmd, path, name, logfile, debug, status):
+    with open(logfile, "w") as file:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=path, encoding="utf-8")
+        for line in proc.stdout:
+            file.write(_ANSI.sub("", line))
+            step = _BUILDX_STEP.match(line)
+            if step and status is not None:
+                status.step(name, "step " + step.group(1))
+        returncode = proc.wait()
+
+    if not debug and returncode == 0:
+        os.remove(logfile)
+    return returncode == 0
+
+
+def _platform_tag(name, platform):
+    suffix = platform.replace("/", "-")
+    if ":" in name.rsplit("/", 1)[-1]:
+        return name + "-" + suffix
+    return name + ":" + suffix
+
+
+def _buildx(name, path, dockerfile, build_args, labels, arch, logfile, debug, context=None, status=None,
+            limits=None, cache_to=None, cache_from=None, load=False, split=False):
+    _buildx_builder()
+
+    platforms = arch.split(",") if arch is not None else []
+    if split and len(platforms) > 1:
+        tags = [_platform_tag(name, platform) for platform in platforms]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(platforms)) as executor:
+            futures = [executor.submit(_buildx, tag, path, dockerfile, build_args, labels, platform,
+                                       logfile[:-len(".log")] + "-" + platform.replace("/", "-") + ".log",
+                                       debug, status=None, cache_to=cache_to, cache_from=cache_from)
+                       for tag, platform in zip(tags, platforms)]
+            if not all([future.result() for future in futures]):
+                return False
+        if status is not None:
+            status.step(name, "manifest")
+        return _buildx_run(["docker", "buildx", "imagetools", "create",
+                            "--builder", "ignishpc",
+                            "--tag", name] + tags, None, name, logfile, debug, None)
 
-    if debug or result.returncode != 0:
-        _dump_log([{'stream': result.stdout.decode("utf-8")}], logfile)
+    raw_build_args = sum([["--build-arg", arg + "=" + val] for arg, val in build_args.items()], [])
+    raw_labels = sum([["--label", lab + "=" + val] for lab, val in labels.items()], [])
 
-    return result.returncode == 0
+    raw_cache = list()
+    if cache_to is not None:
+        raw_cache += ["--cache-to", _buildx_cache(cache_to, name, True)]
+    if cache_from is not None:
+        raw_cache += ["--cache-from", _buildx_cache(cache_from, name, False)]
+    else:
+        raw_cache.append("--no-cache")
+
+    return _buildx_run(["docker", "buildx", "build",
+                        "--builder", "ignishpc",
+                        "--file", dockerfile,
+                        "--progress", "plain",
+                        "--load" if load else "--push",
+                        "--tag", name,
+                        "."] + (["--platform", arch] if arch is not None else []) +
+                       raw_cache + raw_build_args + raw_labels, path, name, logfile, debug, status)
+
+
+def _bake(plan, file, logfile, debug, status, load=False):
+    _buildx_builder()
+    bake._write(plan, file)
+    return _buildx_run(["docker", "buildx", "bake",
+                        "--builder", "ignishpc",
+                        "--file", os.path.abspath(file),
+                        "--progress", "plain",
+                        "--load" if load else "--push"], None, "bake", logfile, debug, status)
 
 
 def _run(args):
+    if (args.bake is not None or args.load or args.split_platforms) and not args.buildx:
+        raise RuntimeError("--bake, --load and --split-platforms require --buildx")
+    if args.load and args.arch is not None and "," in args.arch:
+        raise RuntimeError("--load only supports a single platform")
+    if len(args.docker_hosts) > 0 and (args.buildx or args.max_cores is not None or args.max_memory is not None):
+        raise RuntimeError("--docker-host is not compatible with --buildx, --max-cores and --max-memory")
+    if args.max_memory is not None and args.buildx:
+        raise RuntimeError("--max-memory is not compatible with --buildx")
+    if args.registry_cache == "push" and args.load:
+        raise RuntimeError("--registry-cache push is not compatible with --load, the images are not in the registry")
+    if args.changed_since is not None and args.bake is not None:
+        raise RuntimeError("--changed-since is not compatible with --bake")
+
     build_args = {
         "REGISTRY": args.registry,
         "NAMESPACE": args.namespace,
         "TAG": args.tag,
-        "BUILD_CORES": str(os.cpu_count()) if args.jobs is None else args.jobs,
+        "BUILD_CORES": str(os.cpu_count() if args.jobs is None else args.jobs),
         "VERSION": "dev" if args.tag == "latest" else args.tag
     }
 
@@ -209,6 +462,8 @@ def _run(args):
     if build_args["NAMESPACE"] is None:
         build_args["NAMESPACE"] = configuration.get_string("ignis.container.docker.namespace")
 
+    if len(args.docker_hosts) > 1 and len(build_args["REGISTRY"]) == 0:
+        raise RuntimeError("--docker-host with more than one host requires a registry to move the images")
     if len(build_args["REGISTRY"]) != 0 and not build_args["REGISTRY"].endswith("/"):
         build_args["REGISTRY"] += "/"
     if len(build_args["NAMESPACE"]) != 0 and not build_args["NAMESPACE"].endswith("/"):
@@ -220,22 +475,15 @@ def _run(args):
         new_folder = _folder_gen(wd)
         print("Sources:")
         sources = list()
+        origins = dict()
 
-        for i, src in enumerate(args.sources):
-            target = next(new_folder)
-            os.mkdir(target)
-            if "://" in src:
-                field = src.split("@") if "@" in src else src.split()
-                if len(field) == 2:
-                    git.Repo.clone_from(field[0], target, branch=field[1])
-                else:
-                    git.Repo.clone_from(field[0], target)
-                shutil.rmtree(os.path.join(target, ".git"), ignore_errors=True)
-            else:
-                shutil.copytree(src, target, dirs_exist_ok=True, ignore=_ignore_hidden)
+        targets = [next(new_folder) for _ in args.sources]
+        fetched = fetch._fetch_all(args.sources, targets, lambda t: _referenced(t, build_args), not args.no_source_cache)
+        for src, target in zip(args.sources, fetched):
             if "Dockerfiles" in os.listdir(target):
                 print(" ", src)
                 sources.append(target)
+                origins[target] = src
             else:
                 shutil.rmtree(target, ignore_errors=True)
 
@@ -250,7 +498,9 @@ def _run(args):
                     name = subpath.replace("/", "-")
                     if name in dockerfiles:
                         raise RuntimeError(name + " is defined multiple times")
-                    dockerfiles[name] = _parse_dockerfile(folder, subpath, name)
+                    dock_dir = os.path.relpath(path, src) + "/"
+                    dockerfiles[name] = _parse_dockerfile(folder, subpath, name,
+                                                          dict(build_args, DOCK_DIR=dock_dir, RELPATH=dock_dir))
 
         for name, dockerfile in list(dockerfiles.items()):
             ignored = any([fnmatch.fnmatch(name, pat) for pat in args.ignore])
@@ -309,12 +559,18 @@ def _run(args):
                 msg = " #no sources" if lib not in dockerfiles else ""
                 print("  " + lib.split("-", maxsplit=1)[1] + " (" + core + ")" + msg)
 
+        build_history = history._load()
+        cores = _core_order(cores, build_history)
+        volatile = _volatile_cores(cores, build_history)
+
         if args.core_images:
             for core in cores:
-                dockerfiles[core] = _create_dockerfile(next(new_folder), core, _rmdup(["base", core]), libs, build_args)
+                dockerfiles[core] = _create_dockerfile(next(new_folder), core, _rmdup(["base", core]), libs, build_args,
+                                                       args.compact_layers, volatile)
 
         if args.name != '-':
-            dockerfiles[args.name] = _create_dockerfile(next(new_folder), args.name, cores, libs, build_args)
+            dockerfiles[args.name] = _create_dockerfile(next(new_folder), args.name, cores, libs, build_args,
+                                                        args.compact_layers, volatile)
 
         print()
         print("Images:")
@@ -327,50 +583,249 @@ def _run(args):
             print(" ", image)
 
         print()
-        build = set()
         print("Build:")
-        max_it = len(dockerfiles) + 1
-        while len(build) != len(dockerfiles):
-            max_it -= 1
+        deps = dict()
+        required = dict()
+        for name, dockerfile in dockerfiles.items():
+            required[name] = {_replace_all(rawdep, build_args) for rawdep in dockerfile.requires}
+            deps[name] = {dep for dep in dockerfiles if images_name[dep] in required[name] and dep != name}
+
+        if args.dry_run:
+            f = lambda *a, **k: True
+        elif args.buildx:
+            f = functools.partial(_buildx, cache_to=args.cache_to, cache_from=args.cache_from, load=args.load,
+                                  split=args.split_platforms)
+        else:
+            f = _build
+        status = progress.BuildStatus()
+        contexts = context.ContextCache(os.path.join(wd, "contexts"))
+        durations = history._load()
+        build_state = state.BuildState(args.state).load()
+        images_report = dict()
+        ended = dict()
+
+        plans = dict()
+        external = dict()
+        for name in scheduler._topological(deps):
+            dockerfile = dockerfiles[name]
+            image_args = dict(build_args)
+            local = dockerfile.labels.get("ignis.build.context", False)
+            if not local:
+                dock_path = os.path.relpath(dockerfile.path, os.path.dirname(dockerfile.folder))
+                image_args["DOCK_DIR"] = os.path.dirname(dock_path) + "/"
+                image_args["RELPATH"] = image_args["DOCK_DIR"]  # legacy
+            image_args = {key: val for key, val in image_args.items() if key in dockerfile.args}
+            path = os.path.dirname(dockerfile.folder) if not local else os.path.dirname(dockerfile.path)
+            selection = None
+            if not local and not args.full_context:
+                sources = [_replace_all(src, image_args) for src in dockerfile.sources]
+                selection = context._selection(path, os.path.dirname(dockerfile.path), sources)
+            digest = contexts.digest(path, selection)
+            parents = [plans[dep].hash for dep in deps[name]]
+            for ref in sorted(required[name] - {images_name[dep] for dep in deps[name]}):
+                if ref not in external:
+                    # an unknown parent must never match a previous build
+                    external[ref] = _parent_digest(ref) or "unresolved:" + uuid.uuid4().hex
+                parents.append(external[ref])
+            input_hash = _input_hash(dockerfile, image_args, digest, parents, args.arch)
+            plans[name] = _Plan(local, path, image_args, selection, input_hash)
+
+        estimations = {name: history._duration(durations, dockerfiles[name].name, plans[name].hash)
+                       for name in dockerfiles}
+        known = [value for value in estimations.values() if value is not None]
+        default = sum(known) / len(known) if len(known) > 0 else 1
+        resources = None
+        if args.max_cores is not None or args.max_memory is not None:
+            resources = scheduler.Resources(args.max_cores, args.max_memory)
             for name, dockerfile in dockerfiles.items():
-                if images_name[name] in build:
-                    continue
-                if max_it == 0:
-                    raise RuntimeError("dependency loop in" + name)
-                local = dockerfile.labels.get("ignis.build.context", False)
-                if not local:
-                    dock_path = os.path.relpath(dockerfile.path, os.path.dirname(dockerfile.folder))
-                    build_args["DOCK_DIR"] = os.path.dirname(dock_path) + "/"
-                    build_args["RELPATH"] = build_args["DOCK_DIR"]  # legacy
-
-                deps = [_replace_all(rawdep, build_args) for rawdep in dockerfile.requires]
-                if any(dep in images and dep not in build and dep != images_name[name] for dep in deps):
-                    continue
-
-                print(" ", images_name[name], end="...", flush=True)
-                logfile = dockerfile.name + ".log"
-
-                if args.dry_run:
-                    f = lambda *a, **k: True
-                elif args.buildx:
-                    f = _buildx
-                else:
-                    f = _build
-
-                ok = f(name=images_name[name],
-                       path=os.path.dirname(dockerfile.folder) if not local else os.path.dirname(dockerfile.path),
-                       dockerfile=dockerfile.path if not local else os.path.basename(dockerfile.path),
-                       build_args={key: val for key, val in build_args.items() if key in dockerfile.args},
-                       labels={"ignis.version": build_args["VERSION"]},
-                       arch=args.arch,
-                       logfile=logfile,
-                       debug=args.log)
-                if ok:
-                    print("OK")
+                cores, memory = None, None
+                try:
+                    if args.max_cores is not None:
+                        cores = args.jobs or max(1, args.max_cores // max(1, args.parallel))
+                        cores = int(dockerfile.labels.get("ignis.build.cores", cores))
+                    if args.max_memory is not None:
+                        memory = args.max_memory // max(1, args.parallel)
+                        memory = parse_size(dockerfile.labels.get("ignis.build.memory", str(memory)))
+                except ValueError as ex:
+                    raise RuntimeError(dockerfile.subpath + " has an invalid build label: " + str(ex))
+                resources.request(name, cores, memory)
+
+        dirty = set(dockerfiles)
+        if args.changed_since is not None:
+            changed_files = dict()
+            for target, src in origins.items():
+                if "://" not in src:
+                    changed_files[target] = changes._changed_files(src, args.changed_since)
+            changed = dict()
+            for name, dockerfile in dockerfiles.items():
+                root = os.path.dirname(dockerfile.folder)
+                if root in changed_files:
+                    local, path, _, selection, _ = plans[name]
+                    folder = os.path.relpath(os.path.dirname(dockerfile.path), root) if local else ""
+                    changed[name] = changes._changed(changed_files[root], folder, selection)
                 else:
-                    print("ERROR", "->", logfile)
+                    # generated images depend only on their parents, remote sources can not be compared
+                    changed[name] = root in origins
+            dirty = changes._dirty(scheduler._topological(deps), deps, changed)
+            print(" ", len(dirty), "of", len(dockerfiles), "images changed since", args.changed_since)
+        previous_tag = ":" + args.previous_tag if len(args.previous_tag) > 0 else ""
+
+        priority = scheduler._downstream(deps, {name: value if value is not None else default
+                                                for name, value in estimations.items()})
+
+        build_farm = None
+        if len(args.docker_hosts) > 0:
+            build_farm = farm.Farm([farm._parse_host(host) for host in args.docker_hosts])
+            print("  farm:", ", ".join(host.url + "=" + str(host.slots) for host in build_farm.hosts))
+
+        if args.bake is not None:
+            targets = dict()
+            for name in scheduler._topological(deps):
+                local, path, image_args, _, input_hash = plans[name]
+                targets[name] = bake._target(
+                    image=images_name[name],
+                    context=path,
+                    dockerfile=os.path.relpath(dockerfiles[name].path, path),
+                    args=image_args,
+                    labels={"ignis.version": build_args["VERSION"], "ignis.build.hash": input_hash},
+                    platforms=args.arch,
+                    parents={images_name[dep]: dep for dep in deps[name]},
+                    cache_to=_buildx_cache(args.cache_to, images_name[name], True),
+                    cache_from=_buildx_cache(args.cache_from, images_name[name], False)
+                )
+            plan = bake._plan(targets)
+            if args.dry_run:
+                # the workspace is removed at exit, the plan uses a copy next to the bake file
+                workspace = os.path.abspath(os.path.splitext(args.bake)[0] + ".workspace")
+                shutil.rmtree(workspace, ignore_errors=True)
+                shutil.copytree(wd, workspace, symlinks=True,
+                                ignore=lambda path, names: ["contexts"] if path == wd else [])
+                for target in plan["target"].values():
+                    target["context"] = os.path.join(workspace, os.path.relpath(target["context"], wd))
+                bake._write(plan, args.bake)
+                print("  bake plan written to", args.bake, "with its sources in", workspace)
+            else:
+                with status:
+                    status.start("bake")
+                    ok = _bake(plan, args.bake, "bake.log", args.log, status, args.load)
+                    status.finish("bake", "OK" if ok else "ERROR -> bake.log")
+                if not ok:
                     raise RuntimeError("Build abort")
+            print("Build End")
+            return
+
+        def build_image(name):
+            dockerfile = dockerfiles[name]
+            local, path, image_args, selection, input_hash = plans[name]
+            limits = None
+            if resources is not None:
+                cores, memory = resources.requests[name]
+                limits = dict()
+                if cores is not None:
+                    if "BUILD_CORES" in image_args:
+                        image_args = dict(image_args, BUILD_CORES=str(cores))
+                    if resources.cpuset(name) is not None:
+                        limits["cpusetcpus"] = resources.cpuset(name)
+                if memory is not None:
+                    limits["memory"] = memory
+                    limits["memswap"] = memory
+            logfile = dockerfile.name + ".log"
+            ready = max([ended[dep] for dep in deps[name]] + [start])
+            parents = [images_name[dep] for dep in deps[name]]
+            host = build_farm.acquire(parents) if build_farm is not None else None
+            client = farm._client(host) if host is not None and not args.dry_run else None
+            extra = dict(client=client) if client is not None else dict()
+            status.start(images_name[name])
+            started = time.time()
 
-                build.add(images_name[name])
-
+            try:
+                completed = build_state.completed(name, input_hash) if args.resume else None
+                if completed is not None and (args.buildx or args.dry_run or
+                                              _image_info(images_name[name], client)[0] == completed["digest"]):
+                    result = "RESUMED"
+                elif not args.no_cache and not args.buildx and _cached(images_name[name], input_hash, client):
+                    result = "CACHED"
+                elif args.registry_cache is not None and not args.dry_run and _registry_pull(
+                        _hash_tag(images_name[name], input_hash), images_name[name], input_hash,
+                        args.buildx and not args.load, client):
+                    result = "PULLED"
+                elif name not in dirty and (args.dry_run or _retag(
+                        build_args["REGISTRY"] + build_args["NAMESPACE"] + dockerfile.name + previous_tag,
+                        images_name[name], args.buildx and not args.load, client)):
+                    result = "RETAGGED"
+                else:
+                    if host is not None and not args.dry_run:
+                        build_farm.pull(host, parents)
+                    result = "OK" if f(name=images_name[name],
+                                       path=path,
+                                       dockerfile=dockerfile.path if not local else os.path.basename(dockerfile.path),
+                                       build_args=image_args,
+                                       labels={"ignis.version": build_args["VERSION"], "ignis.build.hash": input_hash},
+                                       arch=args.arch,
+                                       logfile=logfile,
+                                       debug=args.log,
+                                       context=contexts.archive(path, selection) if f is _build and not local else None,
+                                       status=status,
+                                       limits=limits,
+                                       **extra) else "ERROR"
+                if args.registry_cache == "push" and result == "OK" and not args.dry_run:
+                    _registry_push(images_name[name], _hash_tag(images_name[name], input_hash), args.buildx, client)
+                if host is not None and result != "ERROR" and not args.dry_run:
+                    build_farm.push(host, images_name[name])
+                digest, image_size, layers = None, None, None
+                if result != "ERROR" and not args.dry_run and not args.buildx:
+                    digest, image_size, layers = _image_info(images_name[name], client)
+            except Exception:
+                status.finish(images_name[name], "ERROR")
+                raise
+            finally:
+                if client is not None:
+                    client.close()
+                if host is not None:
+                    build_farm.release(host)
+
+            elapsed = status.finish(images_name[name], result if result != "ERROR" else result + " -> " + logfile)
+            if result != "ERROR" and not args.dry_run:
+                build_state.add(name, images_name[name], input_hash, digest)
+            if result == "OK" and not args.dry_run:
+                history._record(durations, dockerfile.name, input_hash, elapsed)
+            images_report[name] = {
+                "image": images_name[name],
+                "status": result,
+                "cache": result in ("CACHED", "RESUMED", "RETAGGED", "PULLED"),
+                "time": elapsed if not args.dry_run else estimations[name],
+                "queue_wait": started - ready if not args.dry_run else None,
+                "context_size": contexts.size(path, selection),
+                "image_size": image_size,
+                "layers": layers,
+                "host": host
+            }
+            ended[name] = time.time()
+            return result != "ERROR"
+
+        start = time.time()
+        try:
+            with status:
+                parallel = build_farm.slots if build_farm is not None else args.parallel
+                failed = scheduler._schedule(deps, build_image, parallel, priority, resources)
+        finally:
+            if not args.dry_run:
+                history._save(durations)
+        build_report = report._create({name: images_report[name] for name in scheduler._topological(deps)
+                                       if name in images_report},
+                                      deps, time.time() - start, args.dry_run, args.parallel)
+        if args.report is not None:
+            report._write(build_report, args.report)
+        if failed is not None:
+            print("Build state saved in", build_state.path + ", use --resume to continue the build")
+            raise RuntimeError("Build abort")
+        build_state.remove()
+
+        if len(contexts.archives) > 0:
+            print("Contexts:", len(contexts.archives), "archives,", progress._size_format(contexts.archived), "archived,",
+                  progress._size_format(contexts.pruned), "pruned from the full sources,",
+                  progress._size_format(contexts.reused), "reused")
+        print()
+        print("Report:")
+        report._print(build_report)
         print("Build End")
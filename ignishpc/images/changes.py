@@ -0,0 +1,42 @@
+import os
+
+import git
+
+from ignishpc.images import context
+
+
+# Files of a local source modified since ref, relative to the source folder. Hidden files are never copied
+# from a local source, so their changes are ignored.
+def _changed_files(src, ref):
+    try:
+        repo = git.Repo(src, search_parent_directories=True)
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+        raise RuntimeError("--changed-since requires a git repository, " + src + " is not inside one")
+    prefix = os.path.relpath(os.path.abspath(src), repo.working_tree_dir)
+    try:
+        changed = set(repo.git.diff("--name-only", ref, "--").splitlines())
+    except git.GitCommandError as ex:
+        raise RuntimeError("can not compare " + src + " with " + ref + ": " + str(ex.stderr).strip())
+    changed.update(repo.untracked_files)
+    files = set()
+    for path in changed:
+        path = os.path.relpath(path, prefix)
+        if path.startswith("..") or any(field.startswith(".") for field in path.split("/")):
+            continue
+        files.add(path)
+    return files
+
+
+def _changed(files, folder, selection):
+    if selection is None:
+        return any(path == folder or path.startswith(folder + "/") for path in files) if folder else len(files) > 0
+    return any(context._selected(path, selection) for path in files)
+
+
+# Images that must be rebuilt, changed images and all of their dependents
+def _dirty(order, deps, changed):
+    dirty = set()
+    for name in order:
+        if changed[name] or any(dep in dirty for dep in deps[name]):
+            dirty.add(name)
+    return dirty
@@ -1,4 +1,4 @@
-from ignishpc.common.formatter import SmartFormatter, desc
+from ignishpc.common.formatter import SmartFormatter, desc, positive_t, size_t
 
 
 def _cmd(args):
@@ -20,7 +20,7 @@ def setup(subparsers):
                                epilog="""Examples:
                                      | $ ignishpc images build --buildx --arch linux/amd64,linux/arm64,linux/ppc64le
                                      | $ ignishpc images build -g coreA -g coreB --core-images --name -
-                                     | $ ignishpc images build -a -s URL""")
+                                     | $ ignishpc images build -a -s URL --parallel 4""")
 
     build.add_argument("-s", "--source", dest="sources", action="append", metavar="path/url",
                        help="repository URL or path. URL can specify a tag \"<URL> [tag]\"", default=[])
@@ -30,6 +30,9 @@ def setup(subparsers):
                        help="ignore images that contains wildcard in name", default=[])
     build.add_argument("--core-images", action="store_true",
                        help="build isolated cores image", default=False)
+    build.add_argument("--compact-layers", action="store_true", default=False,
+                       help="core images copy each builder in its own stage and install them in two layers, "
+                            "cores that change less often go in the lower one")
     build.add_argument("-r", "--registry", action="store", metavar="str",
                        help="set image registry, default is the Docker Hub")
     build.add_argument("-n", "--namespace", action="store", metavar="str",
@@ -44,21 +47,82 @@ def setup(subparsers):
                        help="build optional images")
     build.add_argument("-j", "--jobs", action="store", metavar="n", type=int,
                        help="try to set a limit of cores to build an image, default auto")
+    build.add_argument("--parallel", action="store", metavar="n", type=positive_t, default=1,
+                       help="number of images that can be built at the same time, default 1")
+    build.add_argument("--docker-host", dest="docker_hosts", action="append", metavar="url[=n]", default=[],
+                       help="build in a farm of docker hosts with n concurrent builds each (default 1), images are "
+                            "moved between hosts through the registry. Can be used multiple times")
+    build.add_argument("--max-cores", action="store", metavar="n", type=positive_t,
+                       help="limit the cores used by all builds, each image gets a share or the value of its "
+                            "'ignis.build.cores' label")
+    build.add_argument("--max-memory", action="store", metavar="size", type=size_t,
+                       help="limit the memory used by all builds, each image gets a share or the value of its "
+                            "'ignis.build.memory' label")
     build.add_argument("--ignore", action="store", metavar="folder", nargs="+",
                        help="ignore images that contains wildcard pattern in name", default=[])
     build.add_argument("--enable", action="store", metavar="folder", nargs="+",
                        help="enable optional images that contains wildcard pattern in name", default=[])
+    build.add_argument("--no-source-cache", action="store_true", default=False,
+                       help="clone repositories directly instead of using the local mirrors in ~/.ignis/cache")
+    build.add_argument("--full-context", action="store_true", default=False,
+                       help="send the whole source as build context instead of only the files used by each Dockerfile")
+    build.add_argument("--no-cache", action="store_true", default=False,
+                       help="rebuild images even if a local image was built from the same inputs")
+    build.add_argument("--registry-cache", action="store", nargs="?", const="pull", choices=["pull", "push"],
+                       help="pull images already published in the registry with the same inputs instead of building "
+                            "them, 'push' also publishes the built images with their input tag 'build-<hash>'")
     build.add_argument("--dry-run", action="store_true", default=False,
                        help="perform a simulation of the build with checks but without creating any images")
+    build.add_argument("--changed-since", action="store", metavar="ref",
+                       help="build only the images of local sources changed since the git ref and their dependents, "
+                            "the rest are tagged from --previous-tag")
+    build.add_argument("--previous-tag", action="store", metavar="str", default="latest",
+                       help="tag of the unchanged images used with --changed-since, default 'latest'")
+    build.add_argument("--resume", action="store_true", default=False,
+                       help="skip the images completed by a previous failed build with the same inputs")
+    build.add_argument("--state", action="store", metavar="path", default="ignis-build-state.json",
+                       help="file where the completed images are recorded, default 'ignis-build-state.json'")
+    build.add_argument("--report", action="store", metavar="path",
+                       help="write a json report of the build, with --dry-run the times are estimated from "
+                            "previous builds")
     build.add_argument("--buildx", action="store_true", default=False,
                        help="perform multi-architecture building using Buildx. The result will be pushed and removed. "
                             "The docker binary binary must be available in PATH and the buildx plugin installed")
+    build.add_argument("--load", action="store_true", default=False,
+                       help="with --buildx, load the result into the local Docker instead of pushing it, "
+                            "only for a single platform")
+    build.add_argument("--split-platforms", action="store_true", default=False,
+                       help="with --buildx, build every platform in parallel as a separate image and join them in a "
+                            "manifest list. Nodes added to the 'ignishpc' builder build their native platforms")
+    build.add_argument("--bake", action="store", metavar="path", nargs="?", const="docker-bake.json",
+                       help="with --buildx, write a bake file with all the images (default 'docker-bake.json') and "
+                            "build them in a single BuildKit session. With --dry-run, only the bake file is written "
+                            "and the sources are kept in '<path>.workspace'")
+    build.add_argument("--cache-to", action="store", metavar="spec", nargs="?", const="registry",
+                       help="export the Buildx layer cache, 'registry' (default) stores it as '<image>-buildcache' "
+                            "in the registry, 'local:<folder>' in a folder, any other value is a BuildKit cache spec")
+    build.add_argument("--cache-from", action="store", metavar="spec", nargs="?", const="registry",
+                       help="import the Buildx layer cache, same values as --cache-to")
+
+    cache = actions.add_parser("cache", **desc("Manage the repository mirrors used by builds"))
+    cache_actions = cache.add_subparsers(dest="cache_action", title="Available Actions", metavar="<action>")
+    cache_actions.required = True
+    cache_actions.add_parser("list", **desc("Display cached repositories"))
+    prune = cache_actions.add_parser("prune", **desc("Remove least recently used repositories"))
+    prune.add_argument("--size", action="store", metavar="size", type=size_t,
+                       help="keep the cache under this size, default 'ignis.images.cache.sources'")
+    prune.add_argument("-a", "--all", action="store_true", default=False,
+                       help="remove all cached repositories")
 
     _list = actions.add_parser("list", **desc("Display images"))
     _list.add_argument("-p", "--pattern", action="append", metavar="str", default=[],
                        help="filter images by wildcard pattern")
     _list.add_argument("-u", "--untagged", action="store_true",
                        help="display images without tags", default=False)
+    _list.add_argument("--format", action="store", choices=["table", "json"], default="table",
+                       help="output format, json writes one image per line")
+    _list.add_argument("--no-inventory-cache", action="store_true", default=False,
+                       help="ignore the cached inventory and read all images from docker")
 
     rm = actions.add_parser("rm", **desc("Remove images"))
     rm.add_argument("-p", "--pattern", action="append", metavar="str", default=[],
@@ -69,12 +133,33 @@ def setup(subparsers):
                     help="force image removal", default=False)
     rm.add_argument("-y", "--yes", action="store_true",
                     help="skip confirmation prompt for image removal", default=False)
+    rm.add_argument("--parallel", action="store", metavar="n", type=positive_t, default=4,
+                    help="number of images removed at the same time, default 4")
+    rm.add_argument("--prune", action="store_true", default=False,
+                    help="remove the dangling ignis images left after the removal")
+
+    gc = actions.add_parser("gc", **desc("Remove old images following a retention policy"))
+    gc.add_argument("--keep-last", action="store", metavar="n", type=int,
+                    help="keep the n newest images of every repository, default 'ignis.images.gc.last'")
+    gc.add_argument("--keep-days", action="store", metavar="n", type=float,
+                    help="keep images created or used by a job in the last n days, default 'ignis.images.gc.days'")
+    gc.add_argument("--max-size", action="store", metavar="size", type=size_t,
+                    help="remove the least recently used images until the images use less than size, only the "
+                         "newest images of every repository are kept, default 'ignis.images.gc.size'")
+    gc.add_argument("--parallel", action="store", metavar="n", type=positive_t, default=4,
+                    help="number of images removed at the same time, default 4")
+    gc.add_argument("--dry-run", action="store_true", default=False,
+                    help="only display the images that would be removed")
 
     push = actions.add_parser("push", **desc("Push images"))
     push.add_argument("-p", "--pattern", action="append", metavar="str", default=[],
                       help="filter images by wildcard pattern")
     push.add_argument("-y", "--yes", action="store_true",
                       help="skip confirmation prompt for image push", default=False)
+    push.add_argument("--parallel", action="store", metavar="n", type=positive_t, default=4,
+                      help="number of tags pushed at the same time, default 4")
+    push.add_argument("-f", "--force", action="store_true", default=False,
+                      help="push tags even if the registry already has the same image")
 
     pull = actions.add_parser("pull", **desc("Pull a image"))
     pull.add_argument("image", action="store", help="image name")
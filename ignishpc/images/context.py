@@ -0,0 +1,107 @@
+import os
+import glob
+import hashlib
+import threading
+
+import docker.utils
+
+
+def _dockerignore(path):
+    dockerignore = os.path.join(path, ".dockerignore")
+    if not os.path.exists(dockerignore):
+        return None
+    with open(dockerignore) as file:
+        return [line.strip() for line in file.read().splitlines() if line.strip() != "" and line.strip()[0] != "#"]
+
+
+# Paths of the context used by a Dockerfile, None when the whole context is required.
+def _selection(root, folder, sources):
+    selection = {os.path.relpath(folder, root)}
+    for src in sources:
+        if "$" in src:
+            return None
+        src = os.path.normpath(src.lstrip("/"))
+        if src == "." or src.startswith(".."):
+            return None
+        if glob.has_magic(src):
+            selection.update(os.path.relpath(path, root) for path in glob.glob(os.path.join(root, src)))
+        else:
+            selection.add(src)
+    return tuple(sorted(selection))
+
+
+def _selected(path, selection):
+    return any(path == sel or path.startswith(sel + "/") or sel.startswith(path + "/") for sel in selection)
+
+
+class ContextCache:
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.archives = dict()
+        self.archived = 0
+        self.reused = 0
+        self.pruned = 0
+        self._archive_locks = dict()
+        self._files = dict()
+        self._digests = dict()
+        self._lock = threading.Lock()
+
+    def files(self, root, selection=None):
+        with self._lock:
+            if root not in self._files:
+                self._files[root] = sorted(docker.utils.exclude_paths(root, _dockerignore(root) or []))
+        if selection is None:
+            return self._files[root]
+        return [path for path in self._files[root] if _selected(path, selection)]
+
+    def digest(self, root, selection=None):
+        digest = hashlib.sha256()
+        for path in self.files(root, selection):
+            key = os.path.join(root, path)
+            if key not in self._digests:
+                self._digests[key] = self._file_digest(key)
+            digest.update(path.encode("utf-8") + b"\0" + self._digests[key] + b"\0")
+        return digest.hexdigest()
+
+    def size(self, root, selection=None):
+        return sum(os.path.getsize(os.path.join(root, path)) for path in self.files(root, selection)
+                   if os.path.isfile(os.path.join(root, path)))
+
+    def archive(self, root, selection=None):
+        key = (root, selection)
+        files = self.files(root, selection)
+        with self._lock:
+            if key not in self._archive_locks:
+                self._archive_locks[key] = (threading.Lock(), len(self._archive_locks))
+            lock, index = self._archive_locks[key]
+        # only builds with the same context wait for the archive
+        with lock:
+            with self._lock:
+                if key in self.archives:
+                    self.reused += os.path.getsize(self.archives[key])
+                    return self.archives[key]
+            archive = os.path.join(self.folder, str(index) + ".tar")
+            os.makedirs(self.folder, exist_ok=True)
+            with open(archive, "wb") as file:
+                docker.utils.create_archive(root, files=files, fileobj=file)
+            pruned = self.size(root) - self.size(root, selection) if selection is not None else 0
+            with self._lock:
+                self.archives[key] = archive
+                self.archived += os.path.getsize(archive)
+                self.pruned += pruned
+            return archive
+
+    @staticmethod
+    def _file_digest(path):
+        digest = hashlib.sha256()
+        if os.path.islink(path):
+            digest.update(b"l" + os.readlink(path).encode("utf-8"))
+        elif os.path.isdir(path):
+            digest.update(b"d")
+        else:
+            digest.update(b"x" if os.access(path, os.X_OK) else b"-")
+            with open(path, "rb") as stream:
+                for chunk in iter(lambda: stream.read(1 << 20), b""):
+                    digest.update(chunk)
+        return digest.digest()
@@ -0,0 +1,190 @@
+import os
+import re
+import json
+import shlex
+from collections import namedtuple
+
+_DIRECTIVE = re.compile(r"^#\s*([a-zA-Z]+)\s*=\s*(.*?)\s*$")
+_HEREDOC = re.compile(r"(?<!<)<<(?!<)(-?)([\"']?)([A-Za-z_][A-Za-z0-9_]*)\2")
+_HEREDOC_INSTRUCTIONS = ("RUN", "COPY", "ADD")
+_QUOTED = re.compile(r"""(?<!<<)(?<!<<-)("[^"]*"|'[^']*')""")
+_FLAGS = re.compile(r"^((?:--\S+\s+)*)(.*)$", re.DOTALL)
+_VARIABLE = re.compile(r"(?<!\\)\$(?:\{([A-Za-z_][A-Za-z0-9_]*)(?:(:?[-+])([^}]*))?\}|([A-Za-z_][A-Za-z0-9_]*))")
+
+Dockerfile = namedtuple("Dockerfile", "folder, path, subpath, name requires args labels sources stages")
+
+
+def _expand(s, scope):
+    def replace(match):
+        name = match.group(1) or match.group(4)
+        operator = match.group(2)
+        if name not in scope and operator is None:
+            return match.group(0)  # unknown here, may be resolved later with the build args
+        value = scope.get(name) or ""
+        if operator in (":-", "-"):
+            return value if value != "" or (operator == "-" and name in scope) else _expand(match.group(3), scope)
+        if operator in (":+", "+"):
+            return _expand(match.group(3), scope) if value != "" or (operator == "+" and name in scope) else ""
+        return value
+
+    return _VARIABLE.sub(replace, s)
+
+
+def _split(line):
+    try:
+        return shlex.split(line, posix=True)
+    except ValueError:
+        return line.split()
+
+
+def _instructions(path):
+    with open(path) as file:
+        lines = file.read().splitlines()
+
+    unclosed = set()  # instructions with a heredoc without end, their heredocs are ignored
+    while True:
+        escape = "\\"
+        instructions = list()
+        header = True
+        current = None
+        heredocs = list()
+        opened = None
+        for i, line in enumerate(lines):
+            if len(heredocs) > 0:
+                delimiter, strip = heredocs[0]
+                if (line.lstrip("\t") if strip else line) == delimiter:
+                    heredocs.pop(0)
+                continue
+            stripped = line.strip()
+            if header:
+                directive = _DIRECTIVE.match(stripped)
+                if directive and directive.group(1).lower() == "escape":
+                    escape = directive.group(2) or escape
+                    continue
+                if directive:
+                    continue
+                header = False
+            if stripped == "" or stripped.startswith("#"):
+                continue
+            continues = stripped.endswith(escape)
+            if continues:
+                stripped = stripped[:-1].rstrip()
+            current = stripped if current is None else current + " " + stripped
+            if not continues:
+                if current.partition(" ")[0].upper() in _HEREDOC_INSTRUCTIONS and i not in unclosed:
+                    for strip, _, delimiter in _HEREDOC.findall(_QUOTED.sub("", current)):
+                        heredocs.append((delimiter, strip == "-"))
+                    if len(heredocs) > 0:
+                        opened = i
+                instructions.append(current)
+                current = None
+        if current is not None:
+            instructions.append(current)
+        if len(heredocs) == 0:
+            return instructions
+        print("warn: heredoc '" + heredocs[0][0] + "' of " + path + " line " + str(opened + 1) + " is never closed")
+        unclosed.add(opened)
+
+
+def _flags(rest):
+    match = _FLAGS.match(rest.strip())
+    flags = list()
+    for field in _split(match.group(1)):
+        key, _, value = field[2:].partition("=")
+        flags.append((key.lower(), value))
+    return flags, match.group(2)
+
+
+def _fields(body):
+    return json.loads(body) if body.startswith("[") else _split(body)
+
+
+def _parse_dockerfile(folder, subpath, name, build_args=None):
+    build_args = build_args or {}
+    path = os.path.join(folder, subpath, "Dockerfile")
+
+    requires = set()
+    args = set()
+    labels = {}
+    sources = list()
+    stages = list()
+    envs = dict()
+    global_scope = dict()
+    scope = None
+    env = None
+
+    def image_ref(ref):
+        if ref in stages or ref.isdigit():
+            return None
+        return ref
+
+    for line in _instructions(path):
+        instruction, _, rest = line.partition(" ")
+        instruction = instruction.upper()
+        try:
+            if instruction == "ARG":
+                for field in _split(rest):
+                    key, eq, default = field.partition("=")
+                    args.add(key)
+                    target = global_scope if scope is None else scope
+                    if key in build_args:
+                        target[key] = build_args[key]
+                    elif eq:
+                        target[key] = _expand(default, target)
+                    else:
+                        target[key] = global_scope.get(key, "") if scope is not None else ""
+            elif instruction == "FROM":
+                fields = _split(_flags(rest)[1])
+                image = _expand(fields[0], global_scope)
+                stage = fields[2] if len(fields) >= 3 and fields[1].upper() == "AS" else None
+                ref = image_ref(image)
+                env = dict(envs.get(image, {})) if ref is None else dict()
+                scope = dict(env)
+                if ref is not None and ref != "scratch":
+                    requires.add(ref)
+                stages.append(stage if stage is not None else str(len(stages)))
+                envs[stages[-1]] = env
+            elif scope is None:
+                continue
+            elif instruction == "ENV":
+                fields = _split(_expand(rest, scope))
+                if len(fields) > 0 and "=" not in fields[0]:
+                    fields = [fields[0] + "=" + " ".join(fields[1:])]
+                for field in fields:
+                    key, _, value = field.partition("=")
+                    scope[key] = env[key] = value
+            elif instruction == "LABEL":
+                fields = _split(_expand(rest, scope))
+                if len(fields) > 0 and "=" not in fields[0]:
+                    labels[fields[0]] = " ".join(fields[1:])
+                else:
+                    for field in fields:
+                        key, _, value = field.partition("=")
+                        labels[key] = value
+            elif instruction in ("COPY", "ADD"):
+                flags, body = _flags(rest)
+                fields = _fields(body)
+                source_image = dict(flags).get("from")
+                if source_image is not None:
+                    ref = image_ref(_expand(source_image, scope))
+                    if ref is not None:
+                        requires.add(ref)
+                    continue
+                for src in fields[:-1]:
+                    if src.startswith("<<") or "://" in src or src.startswith("git@"):
+                        continue
+                    sources.append(_expand(src, scope))
+            elif instruction == "RUN":
+                flags, _ = _flags(rest)
+                for key, value in flags:
+                    if key != "mount":
+                        continue
+                    options = dict(option.partition("=")[::2] for option in value.split(","))
+                    if "from" in options:
+                        ref = image_ref(_expand(options["from"], scope))
+                        if ref is not None:
+                            requires.add(ref)
+        except Exception as ex:
+            print("warn: " + line + " is ignored by parser, " + str(ex))
+
+    return Dockerfile(folder, path, subpath, name, requires, args, labels, sources, stages)
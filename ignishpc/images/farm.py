@@ -0,0 +1,62 @@
+import threading
+import contextlib
+from collections import namedtuple
+
+import docker
+import docker.utils
+
+Host = namedtuple("Host", "url slots")
+
+
+def _parse_host(value):
+    url, sep, slots = value.rpartition("=")
+    if sep and slots.isdigit():
+        return Host(url, max(1, int(slots)))
+    return Host(value, 1)
+
+
+def _client(url):
+    return docker.DockerClient(base_url=url)
+
+
+# Build endpoints with a concurrency limit, images built on a host are moved to the others through the registry.
+class Farm:
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.slots = sum(host.slots for host in hosts)
+        self.location = dict()
+        self._running = {host.url: 0 for host in hosts}
+        self._lock = threading.Lock()
+
+    def acquire(self, parents):
+        with self._lock:
+            free = [host for host in self.hosts if self._running[host.url] < host.slots]
+            # the host that already has more parents avoids pulls, then the less loaded
+            host = max(free, key=lambda host: (sum(self.location.get(parent) == host.url for parent in parents),
+                                               host.slots - self._running[host.url]))
+            self._running[host.url] += 1
+            return host.url
+
+    def release(self, url):
+        with self._lock:
+            self._running[url] -= 1
+
+    def pull(self, url, parents):
+        with contextlib.closing(_client(url)) as client:
+            for parent in parents:
+                with self._lock:
+                    location = self.location.get(parent)
+                if location is not None and location != url:
+                    repository, tag = docker.utils.parse_repository_tag(parent)
+                    client.images.pull(repository, tag=tag)
+
+    def push(self, url, image):
+        if len(self.hosts) > 1:
+            repository, tag = docker.utils.parse_repository_tag(image)
+            with contextlib.closing(_client(url)) as client:
+                for chunk in client.images.push(repository, tag=tag, stream=True, decode=True):
+                    if "error" in chunk:
+                        raise RuntimeError(image + " push error: " + str(chunk["error"]))
+        with self._lock:
+            self.location[image] = url
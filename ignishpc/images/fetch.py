@@ -0,0 +1,101 @@
+import os
+import shutil
+import hashlib
+import concurrent.futures
+
+import git
+
+from ignishpc.common import cache
+from ignishpc.common import configuration
+from ignishpc.common.formatter import parse_size
+
+SOURCES_CACHE = os.path.join(configuration.CACHE_DIR, "sources")
+
+
+def _ignore_hidden(path, names):
+    hidden = []
+    for name in names:
+        if name.startswith("."):
+            hidden.append(name)
+    return set(hidden)
+
+
+def _clone(url, target, branch, referenced):
+    options = dict(depth=1, no_checkout=True, filter="blob:none")
+    if branch is not None:
+        options["branch"] = branch
+    repo = git.Repo.clone_from(url, target, **options)
+    try:
+        repo.git.sparse_checkout("set", "--no-cone", "/Dockerfiles/", "/.dockerignore")
+        repo.git.checkout()
+        paths = referenced(target)
+        if paths is None:
+            repo.git.sparse_checkout("disable")
+        elif len(paths) > 0:
+            repo.git.sparse_checkout("add", *["/" + path.lstrip("/") for path in paths])
+    except git.GitCommandError:
+        # sparse checkout failed or not supported, use the whole repository
+        try:
+            repo.git.sparse_checkout("disable")
+        except git.GitCommandError as ex:
+            if "sparse-checkout" not in str(ex.stderr) or "not a git command" not in str(ex.stderr):
+                raise
+        repo.git.checkout()
+
+
+def _mirror_path(url):
+    return os.path.join(SOURCES_CACHE, hashlib.sha256(url.encode("utf-8")).hexdigest()[:16] + ".git")
+
+
+def _mirror_url(path):
+    try:
+        return git.Repo(path).remotes.origin.url
+    except (git.GitError, AttributeError, ValueError):
+        return None
+
+
+def _update_mirror(url, mirror):
+    if os.path.exists(mirror):
+        git.Repo(mirror).git.remote("update", "--prune")
+    else:
+        git.Repo.clone_from(url, mirror, mirror=True)
+    cache.touch(mirror)
+
+
+def _mirrors():
+    return [(path, used, size, _mirror_url(path)) for path, used, size in cache.entries(SOURCES_CACHE, ".git")]
+
+
+def _prune(limit):
+    return cache.evict(SOURCES_CACHE, limit, ".git")
+
+
+def _cache_limit():
+    return parse_size(configuration.get_string("ignis.images.cache.sources", "10GB"))
+
+
+def _fetch(src, target, referenced, use_cache=True):
+    os.mkdir(target)
+    if "://" in src:
+        field = src.split("@") if "@" in src else src.split()
+        branch = field[1] if len(field) == 2 else None
+        if use_cache:
+            mirror = _mirror_path(field[0])
+            with cache.lock(mirror + ".lock"):
+                _update_mirror(field[0], mirror)
+                _clone("file://" + mirror, target, branch, referenced)
+        else:
+            _clone(field[0], target, branch, referenced)
+        shutil.rmtree(os.path.join(target, ".git"), ignore_errors=True)
+    else:
+        shutil.copytree(src, target, dirs_exist_ok=True, ignore=_ignore_hidden)
+    return target
+
+
+def _fetch_all(sources, targets, referenced, use_cache=True):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(sources))) as executor:
+        futures = [executor.submit(_fetch, src, target, referenced, use_cache) for src, target in zip(sources, targets)]
+        result = [future.result() for future in futures]
+    if use_cache and any("://" in src for src in sources):
+        _prune(_cache_limit())
+    return result
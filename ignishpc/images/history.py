@@ -0,0 +1,46 @@
+import os
+import json
+import time
+
+from ignishpc.common import configuration
+
+HISTORY_FILE = os.path.join(configuration.CACHE_DIR, "build-history.json")
+_MAX_ENTRIES = 10
+
+
+def _load():
+    try:
+        with open(HISTORY_FILE) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(history):
+    os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+    tmp = HISTORY_FILE + "." + str(os.getpid())
+    with open(tmp, "w") as file:
+        json.dump(history, file)
+    os.replace(tmp, HISTORY_FILE)
+
+
+def _record(history, name, input_hash, duration):
+    entries = [entry for entry in history.get(name, []) if entry["hash"] != input_hash]
+    entries.append({"hash": input_hash, "duration": duration, "date": int(time.time())})
+    history[name] = entries[-_MAX_ENTRIES:]
+
+
+def _duration(history, name, input_hash=None):
+    entries = history.get(name, [])
+    for entry in entries:
+        if entry["hash"] == input_hash:
+            return entry["duration"]
+    return entries[-1]["duration"] if len(entries) > 0 else None
+
+
+# Builds with new inputs per day in the recorded period, 0 if it can't be known
+def _change_rate(history, name):
+    dates = sorted(entry["date"] for entry in history.get(name, []) if "date" in entry)
+    if len(dates) < 2:
+        return 0
+    return (len(dates) - 1) / max(dates[-1] - dates[0], 24 * 3600) * 24 * 3600
@@ -3,18 +3,29 @@ import os
 import docker
 import docker.errors
 import docker.types
+import docker.utils
 import subprocess
-import fnmatch
+import json
+import time
 import datetime
 import tempfile
+import concurrent.futures
 
 from ignishpc.common import configuration
+from ignishpc.common import usage
+from ignishpc.common.formatter import parse_size
 from ignishpc.images import build
+from ignishpc.images import fetch
+from ignishpc.images import inventory
+from ignishpc.images import progress
+from ignishpc.images import scheduler
 
 
 def _run(args):
     return {
         "build": build._run,
+        "cache": _cache,
+        "gc": _gc,
         "list": _list,
         "rm": _rm,
         "push": _push,
@@ -22,38 +33,24 @@ def _run(args):
     }[args.action](args)
 
 
-def _get_images(patterns, untagged=False):
-    client = docker.from_env()
-
-    ignis_images = client.images.list(filters={"label": ["ignis.version"]})
-    images = list()
-
-    for entry in ignis_images:
-        has_pattern = any([any([fnmatch.fnmatch(tag, pat) for tag in entry.tags]) for pat in patterns])
-
-        if (len(entry.tags) > 0 and (len(patterns) == 0 or has_pattern)) or (len(entry.tags) == 0 and untagged):
-            images.append(entry)
-
-    return images
+def _get_images(patterns, untagged=False, use_cache=True):
+    return inventory._filter(inventory._images(use_cache=use_cache), patterns, untagged)
 
 
-def _print_images(images):
-    table = list()
-    for img in images:
-        table.append((img.short_id.split(":")[1],
-                      _image_date(img),
-                      img.attrs["Architecture"] if "Architecture" in img.attrs else "",
-                      " ".join(img.tags) if len(img.tags) > 0 else "<none>"))
-
-        now = datetime.datetime.now()
-        table = sorted(table, key=lambda row: now - (row[1] if row[1] is not None else datetime.datetime.min),
-                       reverse=True)
+def _print_images(images, fmt="table"):
+    images = sorted(images, key=lambda img: img.created or 0, reverse=True)
+    if fmt == "json":
+        for img in images:
+            print(json.dumps(img._asdict()), flush=True)
+        return
 
+    now = time.time()
     print("IMAGE ID       CREATED        ARCH     TAG")
-    for img_id, created, arch, tag in table:
-        print(img_id.ljust(14), (_date_format(now - created) if created is not None else "").ljust(14),
-              arch.ljust(8),
-              tag)
+    for img in images:
+        created = _date_format(datetime.timedelta(seconds=now - img.created)) if img.created is not None else None
+        print(inventory._short_id(img).ljust(14), (created or "").ljust(14),
+              img.arch.ljust(8),
+              " ".join(img.tags) if len(img.tags) > 0 else "<none>")
 
 
 def _ask_before(args):
@@ -65,34 +62,178 @@ def _ask_before(args):
     return args.yes
 
 
+def _cache(args):
+    if args.cache_action == "list":
+        now = datetime.datetime.now()
+        print("SIZE       USED           REPOSITORY")
+        for path, used, size, url in fetch._mirrors():
+            print(progress._size_format(size).ljust(10),
+                  (_date_format(now - datetime.datetime.fromtimestamp(used)) or "now").ljust(14),
+                  url or os.path.basename(path))
+    else:
+        urls = {path: url for path, _, _, url in fetch._mirrors()}
+        limit = 0 if args.all else (args.size if args.size is not None else fetch._cache_limit())
+        removed = fetch._prune(limit)
+        for path, _, size in removed:
+            print("removed", urls.get(path) or os.path.basename(path), progress._size_format(size))
+        print(progress._size_format(sum(entry[2] for entry in removed)), "reclaimed")
+
+
 def _list(args):
-    images = _get_images(args.pattern, args.untagged)
-    _print_images(images)
+    images = _get_images(args.pattern, args.untagged, not args.no_inventory_cache)
+    _print_images(images, args.format)
+
+
+# Bytes that only belong to each image, released when the image is deleted
+def _unique_sizes(usage):
+    sizes = dict()
+    for image in usage.get("Images") or []:
+        shared = image.get("SharedSize", -1)
+        sizes[image["Id"]] = image["Size"] - shared if shared is not None and shared >= 0 else image["Size"]
+    return sizes
 
 
 def _rm(args):
-    images = _get_images(args.pattern, args.untagged)
+    all_images = inventory._images()
+    images = inventory._filter(all_images, args.pattern, args.untagged)
     print("Following images will be deleted:")
     _print_images(images)
 
     if _ask_before(args):
-        to_remove = list()
+        pattern = inventory._pattern(args.pattern)
+        targets = dict()
         for img in images:
-            created = _image_date(img)
-            created = created if created is not None else datetime.datetime.min
             if len(img.tags) > 0:
-                tags = [tag for tag in img.tags if any([fnmatch.fnmatch(tag, pat) for pat in args.pattern])]
-                for tag in tags:
-                    to_remove.append((created, tag))
+                targets[img.id] = [tag for tag in img.tags if pattern is not None and pattern.match(tag)]
             else:
-                to_remove.append((created, img.short_id))
-        client = docker.from_env()
+                targets[img.id] = [inventory._short_id(img)]
+        _remove(all_images, targets, args.force, args.parallel, args.prune)
+
 
-        for _, tag in sorted(to_remove, key=lambda t: t[0], reverse=True):
+# Remove the tags of every image in targets, children are removed before their parents
+def _remove(all_images, targets, force, parallel, prune):
+    client = docker.from_env()
+    parents = {img.id: img.parent for img in all_images}
+    deps = {image_id: set() for image_id in targets}
+    for image_id in targets:
+        parent = parents.get(image_id)
+        while parent is not None and parent not in targets:
+            parent = parents.get(parent)
+        if parent is not None:
+            deps[parent].add(image_id)
+
+    before = client.df()
+    unique = _unique_sizes(before)
+    reclaimed = dict()
+
+    def remove(image_id):
+        reclaimed[image_id] = 0
+        for tag in targets[image_id]:
             try:
-                client.images.remove(image=tag, force=args.force)
+                for entry in client.api.remove_image(tag, force=force) or []:
+                    reclaimed[image_id] += unique.get(entry.get("Deleted"), 0)
             except docker.errors.APIError as ex:
-                print(tag, "can't be removed:", ex.explanation)
+                print(tag, "can't be removed:", ex.explanation, flush=True)
+                return True
+        if len(targets[image_id]) > 0:
+            print("removed", " ".join(targets[image_id]), progress._size_format(reclaimed[image_id]), flush=True)
+        return True
+
+    scheduler._schedule(deps, remove, parallel)
+    if prune:
+        pruned = client.images.prune(filters={"dangling": True, "label": "ignis.version"})
+        print("pruned", len(pruned.get("ImagesDeleted") or []), "dangling images",
+              progress._size_format(pruned.get("SpaceReclaimed") or 0))
+    after = client.df()
+    print(progress._size_format(max(0, before.get("LayersSize", 0) - after.get("LayersSize", 0))), "reclaimed")
+
+
+def _gc(args):
+    keep_last = args.keep_last
+    if keep_last is None:
+        keep_last = int(configuration.get_string("ignis.images.gc.last", "3"))
+    keep_days = args.keep_days
+    if keep_days is None:
+        keep_days = float(configuration.get_string("ignis.images.gc.days", "30"))
+    max_size = args.max_size
+    if max_size is None and configuration.get_string("ignis.images.gc.size", "") != "":
+        max_size = parse_size(configuration.get_string("ignis.images.gc.size"))
+
+    all_images = inventory._images()
+    tagged = [img for img in all_images if len(img.tags) > 0]
+    used = usage.load()
+    now = time.time()
+
+    def last_used(img):
+        return max([used.get(tag, 0) for tag in img.tags] + [img.created or 0])
+
+    # the newest images of every repository are always kept
+    repositories = dict()
+    for img in sorted(tagged, key=lambda img: img.created or 0, reverse=True):
+        for tag in img.tags:
+            repositories.setdefault(docker.utils.parse_repository_tag(tag)[0], dict())[img.id] = img
+    keep = set()
+    for ids in repositories.values():
+        keep.update(list(ids)[:keep_last])
+
+    recent = {img.id for img in tagged if keep_days > 0 and last_used(img) >= now - keep_days * 24 * 3600}
+    remove = [img for img in tagged if img.id not in keep and img.id not in recent]
+
+    if max_size is not None:
+        usage_df = docker.from_env().df()
+        unique = _unique_sizes(usage_df)
+        total = usage_df.get("LayersSize", 0) - sum(unique.get(img.id, 0) for img in remove)
+        for img in sorted(tagged, key=last_used):
+            if total <= max_size:
+                break
+            if img.id not in keep and img.id in recent:
+                remove.append(img)
+                total -= unique.get(img.id, 0)
+
+    if len(remove) == 0:
+        print("Nothing to remove")
+        return
+    print("Following images will be deleted:")
+    _print_images(remove)
+    if not args.dry_run:
+        _remove(all_images, {img.id: img.tags for img in remove}, False, args.parallel, True)
+
+
+def _push_layers(layers, live):
+    done = sum(1 for _, _, pushed in layers.values() if pushed)
+    msg = "{}/{} layers".format(done, len(layers))
+    if live:
+        msg += " " + progress._size_format(sum(layer[0] for layer in layers.values())) + "/" + \
+               progress._size_format(sum(layer[1] for layer in layers.values()))
+    return msg
+
+
+def _push_tag(img, tag, force, status):
+    client = docker.from_env()
+    repository, name = docker.utils.parse_repository_tag(tag)
+    if not force:
+        try:
+            # the registry already has the manifest of the local image
+            if repository + "@" + client.images.get_registry_data(tag).id in img.digests:
+                return "SKIPPED"
+        except docker.errors.DockerException:
+            pass
+    layers = dict()
+    last = None
+    for line in client.images.push(repository, tag=name, stream=True, decode=True):
+        if 'errorDetail' in line:
+            raise RuntimeError(line['errorDetail']['message'])
+        if "id" not in line or "status" not in line or line["status"] in ("Preparing", "Waiting"):
+            continue
+        detail = line.get("progressDetail") or {}
+        current, total, _ = layers.get(line["id"], (0, 0, False))
+        pushed = line["status"] in ("Pushed", "Layer already exists") or line["status"].startswith("Mounted")
+        layers[line["id"]] = (detail.get("current", total if pushed else current), detail.get("total", total), pushed)
+        msg = _push_layers(layers, status.live)
+        if msg != last:
+            status.step(tag, msg)
+            last = msg
+    return "PUSHED"
 
 
 def _push(args):
@@ -101,56 +242,98 @@ def _push(args):
     _print_images(images)
 
     if _ask_before(args):
-        client = docker.from_env()
-        for img in images:
-            for tag in img.tags:
-                print(tag, end="...", flush=True)
-                for line in client.images.push(tag, stream=True, decode=True):
-                    if 'errorDetail' in line:
-                        print("ERROR")
-                        raise RuntimeError(line['errorDetail']['message'])
-                print("PUSHED")
+        results = dict()
+
+        def push(img, tag):
+            status.start(tag)
+            try:
+                results[tag] = _push_tag(img, tag, args.force, status)
+                status.finish(tag, results[tag])
+            except Exception as ex:
+                results[tag] = "ERROR"
+                status.finish(tag, "ERROR " + str(ex))
+
+        with progress.BuildStatus() as status, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.parallel)) as executor:
+            for img in images:
+                for tag in img.tags:
+                    executor.submit(push, img, tag)
+        counts = {result: list(results.values()).count(result) for result in ("PUSHED", "SKIPPED", "ERROR")}
+        print(counts["PUSHED"], "pushed,", counts["SKIPPED"], "skipped,", counts["ERROR"], "failed")
+        if counts["ERROR"] > 0:
+            raise RuntimeError("Push abort")
+
+
+def _docker_socket():
+    host = os.getenv("DOCKER_HOST", "unix:///var/run/docker.sock")
+    if host.startswith("unix://") and os.path.exists(host[len("unix://"):]):
+        return host[len("unix://"):]
+    return None
+
+
+def _throughput(size, elapsed):
+    return progress._size_format(size) + " in " + progress._time_format(elapsed) + " (" + \
+           progress._size_format(size / max(elapsed, 0.001)) + "/s)"
 
 
 def _pull(args):
     provider = configuration.get_string("ignis.container.provider")
+    image = args.image
+    if ":" not in image.split("/")[-1]:
+        image += ":latest"
     if args.singularity is not None and provider != "docker":
         source = "docker-daemon:" if args.local else "docker://"
-        image = args.image
-        if ":" not in image:
-            image += ":latest"
+        env = dict(os.environ)
+        # temporary files in the target filesystem, /tmp of the nodes is usually small
+        env.setdefault(provider.upper() + "_TMPDIR", os.path.dirname(os.path.abspath(args.singularity)))
         print("pulling image")
-        subprocess.run(args=[provider, "pull", "--force", args.singularity, source + image])
+        start = time.time()
+        subprocess.run(args=[provider, "pull", "--force", args.singularity, source + image], env=env)
+        if os.path.exists(args.singularity):
+            print("image saved in " + args.singularity,
+                  _throughput(os.path.getsize(args.singularity), time.time() - start))
         return
 
     client = docker.from_env()
     if args.local and args.singularity is not None:
-        image = client.images.get(args.image)
+        docker_image = client.images.get(args.image)
     else:
         print("pulling image")
-        image = client.images.pull(args.image)
+        docker_image = client.images.pull(args.image)
         print("pull complete")
         if args.singularity is None:
             return
     target = os.path.abspath(args.singularity)
-
-    with tempfile.TemporaryDirectory(prefix="ignis-build-") as wd:
-        source = os.path.abspath(os.path.join(wd, "ignis.image"))
-        print("writing to disk")
-        with open(source, "wb") as file:
-            for chunk in image.save():
-                file.write(chunk)
-            file.flush()
+    size = docker_image.attrs.get("Size", 0)
+    socket = _docker_socket()
+    start = time.time()
+
+    with tempfile.TemporaryDirectory(prefix=".ignis-pull-", dir=os.path.dirname(target)) as wd:
+        mounts = [docker.types.Mount("/target", os.path.dirname(target), "bind")]
+        if socket is not None:
+            # the converter reads the layers directly from the daemon
+            source = "docker-daemon:" + image
+            mounts.append(docker.types.Mount("/var/run/docker.sock", socket, "bind"))
+        else:
+            source = "docker-archive:///target/" + os.path.basename(wd) + "/ignis.image"
+            print("writing to disk")
+            with open(os.path.join(wd, "ignis.image"), "wb") as file:
+                for chunk in docker_image.save():
+                    file.write(chunk)
+                file.flush()
 
         print("converting image to sif format")
+        # the container runs as root, its temporary files are removed inside and the cache stays in the container
+        tmp = "/target/" + os.path.basename(wd) + "/tmp"
         try:
             client.containers.run(
                 image=configuration.format_image("singularity"),
-                command=["sh", "-c", f"singularity pull --force {os.path.basename(target)} docker-archive:///source && "
-                                     f"chown {os.getuid()}:{os.getgid()} {os.path.basename(target)}"],
+                command=["sh", "-c", f"mkdir -p {tmp} && singularity pull --force {os.path.basename(target)} {source}; "
+                                     f"status=$?; rm -rf {tmp}; [ $status -ne 0 ] || "
+                                     f"chown {os.getuid()}:{os.getgid()} {os.path.basename(target)}; exit $status"],
+                environment={"SINGULARITY_TMPDIR": tmp},
                 remove=True,
-                mounts=[docker.types.Mount("/source", source, "bind"),
-                        docker.types.Mount("/target", os.path.dirname(target), "bind")],
+                mounts=mounts,
                 platform=args.arch,
                 working_dir="/target",
                 stdout=True,
@@ -159,18 +342,7 @@ def _pull(args):
 
         except docker.errors.ContainerError as ex:
             raise RuntimeError(ex.stderr)
-        print("image saved in " + args.singularity)
-
-
-def _image_date(img):
-    if 'Created' in img.attrs:
-        sdate = img.attrs['Created']
-        nano = sdate.split(".")[-1]
-        sdate = sdate[0:-len(nano)] + nano[0:6]
-        if sdate[-1] != 'Z':
-            sdate += 'Z'
-        return datetime.datetime.strptime(sdate, '%Y-%m-%dT%H:%M:%S.%fZ')
-    return None
+        print("image saved in " + args.singularity, _throughput(size, time.time() - start))
 
 
 def _date_format(elapsed):
@@ -0,0 +1,94 @@
+import os
+import re
+import json
+import time
+import fnmatch
+from collections import namedtuple
+
+import docker
+import docker.errors
+
+from ignishpc.common import configuration
+
+INVENTORY_FILE = os.path.join(configuration.CACHE_DIR, "images.json")
+
+Image = namedtuple("Image", "id parent tags digests created size arch")
+
+
+def _pattern(patterns):
+    if len(patterns) == 0:
+        return None
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
+
+
+def _load(daemon):
+    try:
+        with open(INVENTORY_FILE) as file:
+            inventory = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return inventory if inventory.get("daemon") == daemon else None
+
+
+def _save(inventory):
+    os.makedirs(os.path.dirname(INVENTORY_FILE), exist_ok=True)
+    tmp = INVENTORY_FILE + "." + str(os.getpid())
+    with open(tmp, "w") as file:
+        json.dump(inventory, file)
+    os.replace(tmp, INVENTORY_FILE)
+
+
+# Any image event (build, tag, untag, push, pull, delete...) since the inventory was created invalidates it
+def _changed(client, since, until):
+    try:
+        for _ in client.events(since=since, until=until, filters={"type": "image"}, decode=True):
+            return True
+    except docker.errors.DockerException:
+        return True
+    return False
+
+
+def _images(client=None, use_cache=True):
+    client = client or docker.from_env()
+    daemon = client.info()["ID"]  # every unix socket has the same base url
+    now = int(time.time())
+    inventory = _load(daemon) if use_cache else None
+    if inventory is not None and not _changed(client, inventory["time"], now):
+        return [Image(*entry) for entry in inventory["images"]]
+
+    # the architecture is the only field that needs an inspect, it never changes for an image id
+    known = {entry[0]: entry[6] for entry in inventory["images"]} if inventory is not None else {}
+    images = list()
+    for summary in client.api.images(filters={"label": ["ignis.version"]}):
+        image_id = summary["Id"]
+        if image_id not in known:
+            try:
+                known[image_id] = client.api.inspect_image(image_id).get("Architecture", "")
+            except docker.errors.NotFound:
+                continue
+        images.append(Image(image_id,
+                            summary.get("ParentId") or None,
+                            [tag for tag in summary.get("RepoTags") or [] if tag != "<none>:<none>"],
+                            [digest for digest in summary.get("RepoDigests") or [] if digest != "<none>@<none>"],
+                            summary.get("Created"),
+                            summary.get("Size"),
+                            known[image_id]))
+    if use_cache:
+        _save({"daemon": daemon, "time": now, "images": images})
+    return images
+
+
+def _filter(images, patterns, untagged=False):
+    pattern = _pattern(patterns)
+    result = list()
+    for image in images:
+        if len(image.tags) == 0:
+            if untagged:
+                result.append(image)
+        elif pattern is None or any(pattern.match(tag) for tag in image.tags):
+            result.append(image)
+    return result
+
+
+def _short_id(image):
+    return image.id.split(":")[-1][:12]
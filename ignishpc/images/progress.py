@@ -0,0 +1,93 @@
+import sys
+import time
+import shutil
+import threading
+
+
+def _time_format(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "{}h{:02d}m{:02d}s".format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    if seconds >= 60:
+        return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+    return "{}s".format(seconds)
+
+
+def _size_format(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TB"
+    return "{:.1f}{}".format(size, unit)
+
+
+class BuildStatus:
+
+    def __init__(self, stream=sys.stdout, interval=1):
+        self.stream = stream
+        self.live = stream.isatty()
+        self.interval = interval
+        self._running = dict()
+        self._width = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.live:
+            self._thread = threading.Thread(target=self._refresh, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            self._clear()
+
+    def start(self, name):
+        with self._lock:
+            self._running[name] = [time.time(), "starting"]
+            self._render()
+
+    def step(self, name, step):
+        with self._lock:
+            self._running[name][1] = step
+            if self.live:
+                self._render()
+            else:
+                print("  " + name + ":", step, _time_format(time.time() - self._running[name][0]),
+                      file=self.stream, flush=True)
+
+    def finish(self, name, msg):
+        with self._lock:
+            elapsed = time.time() - self._running.pop(name)[0]
+            self._clear()
+            print("  " + name + "..." + msg, "(" + _time_format(elapsed) + ")", file=self.stream, flush=True)
+            self._render()
+        return elapsed
+
+    def _refresh(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                self._render()
+
+    def _clear(self):
+        if self._width > 0:
+            self.stream.write("\r" + " " * self._width + "\r")
+            self.stream.flush()
+            self._width = 0
+
+    def _render(self):
+        if not self.live or len(self._running) == 0:
+            return
+        now = time.time()
+        line = " | ".join(name.rsplit("/", 1)[-1] + " " + step + " " + _time_format(now - start)
+                          for name, (start, step) in self._running.items())
+        line = "  " + line[:shutil.get_terminal_size().columns - 3]
+        self.stream.write("\r" + line + " " * max(0, self._width - len(line)))
+        self.stream.flush()
+        self._width = len(line)
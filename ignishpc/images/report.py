@@ -0,0 +1,58 @@
+import json
+
+from ignishpc.images.progress import _time_format, _size_format
+from ignishpc.images import scheduler
+
+
+def _size(value):
+    return _size_format(value) if value is not None else "-"
+
+
+def _time(value):
+    return _time_format(value) if value is not None else "-"
+
+
+def _create(images, deps, total, estimated, parallel=1):
+    # images without a known time weigh the mean like in the scheduler, without any time the path is the deepest
+    known = [entry["time"] for entry in images.values() if entry["time"] is not None]
+    default = sum(known) / len(known) if len(known) > 0 else 1
+    weights = {name: entry["time"] if entry["time"] is not None else default for name, entry in images.items()}
+    critical_time, critical = scheduler._critical_path(deps, weights)
+    if estimated:
+        total = max(critical_time, sum(weights.values()) / max(1, parallel))
+        if len(known) == 0:
+            total, critical_time = None, None
+    return {
+        "estimated": estimated,
+        "time": total,
+        "critical_path": {
+            "time": critical_time,
+            "images": [images[name]["image"] for name in critical]
+        },
+        "images": list(images.values())
+    }
+
+
+def _write(report, path):
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+
+
+def _print(report):
+    print(" ", "IMAGE".ljust(40), "TIME".rjust(9), "WAIT".rjust(9), "CACHE".ljust(6), "CONTEXT".rjust(9),
+          "SIZE".rjust(9), "LAYERS".rjust(6))
+    for entry in report["images"]:
+        print(" ", entry["image"][:40].ljust(40),
+              _time(entry["time"]).rjust(9),
+              _time(entry["queue_wait"]).rjust(9),
+              ("hit" if entry["cache"] else "miss").ljust(6),
+              _size(entry["context_size"]).rjust(9),
+              _size(entry["image_size"]).rjust(9),
+              str(entry["layers"] if entry["layers"] is not None else "-").rjust(6))
+    prefix = "Estimated " if report["estimated"] else ""
+    if report["time"] is None:
+        print(" ", prefix + "time: unknown, no build history")
+    else:
+        print(" ", prefix + "time:", _time(report["time"]))
+    print(" ", prefix + "critical path (" + _time(report["critical_path"]["time"]) + "):",
+          " -> ".join(report["critical_path"]["images"]))
@@ -0,0 +1,166 @@
+import os
+import concurrent.futures
+
+
+def _find_cycle(deps):
+    state = {}
+    for root in deps:
+        if root in state:
+            continue
+        path = [root]
+        stack = [iter(deps[root])]
+        state[root] = 1
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                state[path.pop()] = 2
+                stack.pop()
+            elif state.get(child) == 1:
+                return path[path.index(child):] + [child]
+            elif child not in state and child in deps:
+                state[child] = 1
+                path.append(child)
+                stack.append(iter(deps[child]))
+    return None
+
+
+class Resources:
+
+    def __init__(self, cores=None, memory=None):
+        self.cores = cores
+        self.memory = memory
+        self.requests = dict()
+        self.grants = dict()
+        self._free_cores = list(range(cores)) if cores is not None else None
+        self._free_memory = memory
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        self._cpus = cpus if cores is not None and cores <= len(cpus) else None
+
+    def request(self, name, cores=None, memory=None):
+        if self.cores is not None:
+            cores = min(max(1, cores or 1), self.cores)
+        if self.memory is not None:
+            memory = min(memory or self.memory, self.memory)
+        self.requests[name] = (cores, memory)
+
+    def acquire(self, name):
+        cores, memory = self.requests.get(name, (None, None))
+        if cores is not None and len(self._free_cores) < cores:
+            return False
+        if memory is not None and self._free_memory < memory:
+            return False
+        ids = list()
+        if cores is not None:
+            ids = self._free_cores[:cores]
+            del self._free_cores[:cores]
+        if memory is not None:
+            self._free_memory -= memory
+        self.grants[name] = (ids, memory)
+        return True
+
+    def release(self, name):
+        ids, memory = self.grants.pop(name)
+        if self.cores is not None:
+            self._free_cores.extend(ids)
+        if memory is not None:
+            self._free_memory += memory
+
+    def cpuset(self, name):
+        if self._cpus is None:
+            return None
+        return ",".join(str(self._cpus[i]) for i in sorted(self.grants[name][0]))
+
+
+def _schedule(deps, task, parallel=1, priority=None, resources=None):
+    _topological(deps)
+    children = {name: list() for name in deps}
+    waiting = dict()
+    for name, parents in deps.items():
+        waiting[name] = len(parents)
+        for parent in parents:
+            children[parent].append(name)
+
+    ready = [name for name in deps if waiting[name] == 0]
+    running = dict()
+    failed = None
+    error = None
+    parallel = max(1, parallel)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+        while running or (ready and failed is None):
+            if priority is not None:
+                ready.sort(key=lambda name: priority[name], reverse=True)
+            for name in list(ready):
+                if failed is not None or len(running) >= parallel:
+                    break
+                if resources is not None and not resources.acquire(name):
+                    continue
+                ready.remove(name)
+                running[executor.submit(task, name)] = name
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if resources is not None:
+                    resources.release(name)
+                try:
+                    ok = future.result()
+                except Exception as ex:
+                    ok = False
+                    error = error or ex
+                if not ok:
+                    failed = failed or name
+                    continue
+                for child in children[name]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0:
+                        ready.append(child)
+    if error is not None:
+        raise error
+    return failed
+
+
+def _topological(deps):
+    waiting = {name: len(parents) for name, parents in deps.items()}
+    children = {name: list() for name in deps}
+    for name, parents in deps.items():
+        for parent in parents:
+            children[parent].append(name)
+    order = [name for name in deps if waiting[name] == 0]
+    for name in order:
+        for child in children[name]:
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                order.append(child)
+    if len(order) != len(deps):
+        raise RuntimeError("dependency loop: " + " -> ".join(_find_cycle(deps)))
+    return order
+
+
+# Longest weighted path from every image to the end of the build, including itself.
+def _downstream(deps, weights):
+    children = {name: list() for name in deps}
+    for name, parents in deps.items():
+        for parent in parents:
+            children[parent].append(name)
+    length = dict()
+    for name in reversed(_topological(deps)):
+        length[name] = weights.get(name, 0) + max((length[child] for child in children[name]), default=0)
+    return length
+
+
+def _critical_path(deps, weights):
+    length = dict()
+    prev = dict()
+    for name in _topological(deps):
+        parent = max(deps[name], key=lambda dep: length[dep], default=None)
+        prev[name] = parent
+        length[name] = weights.get(name, 0) + (length[parent] if parent is not None else 0)
+    if len(length) == 0:
+        return 0, []
+    name = max(length, key=lambda n: length[n])
+    total = length[name]
+    path = list()
+    while name is not None:
+        path.append(name)
+        name = prev[name]
+    return total, path[::-1]
@@ -0,0 +1,39 @@
+import os
+import json
+import threading
+
+STATE_FILE = "ignis-build-state.json"
+
+
+class BuildState:
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self.images = dict()
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                self.images = json.load(file).get("images", {})
+        except (OSError, ValueError):
+            self.images = dict()
+        return self
+
+    def completed(self, name, input_hash):
+        entry = self.images.get(name)
+        if entry is not None and entry["hash"] == input_hash:
+            return entry
+        return None
+
+    def add(self, name, image, input_hash, digest):
+        with self._lock:
+            self.images[name] = {"image": image, "hash": input_hash, "digest": digest}
+            tmp = self.path + "." + str(os.getpid())
+            with open(tmp, "w") as file:
+                json.dump({"images": self.images}, file, indent=2)
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -12,6 +12,8 @@ import docker.types
 import docker.errors
 
 from ignishpc.common import configuration
+from ignishpc.common import sif
+from ignishpc.common import usage
 
 
 def _run(args):
@@ -45,6 +47,8 @@ def _docker_stdin(c, con=None):
 
 
 def _container_job(args, it):
+    image = configuration.default_image()
+    usage.record(image)
     wdir = configuration.get_string("ignis.wdir")
     writable = configuration.get_bool("ignis.container.writable")
     network = configuration.network()
@@ -86,6 +90,8 @@ def _container_job(args, it):
 
     provider = configuration.get_string("ignis.container.provider")
     if provider != "docker":
+        if image.startswith("docker://"):
+            image = sif.resolve(image, provider)
         cmd = [provider, "exec", "--cleanenv"]
 
         if wdir is not None:
@@ -104,7 +110,7 @@ def _container_job(args, it):
             cmd.extend(["--bind", bind])
 
         proc = subprocess.Popen(
-            args=cmd + [configuration.default_image(), "ignis-submit"] + args,
+            args=cmd + [image, "ignis-submit"] + args,
             stdin=sys.stdin if it else subprocess.PIPE,
             stderr=subprocess.STDOUT,
             stdout=subprocess.PIPE,
@@ -158,7 +164,7 @@ def _container_job(args, it):
 
         try:
             container = docker.from_env().containers.create(
-                image=configuration.default_image(),
+                image=image,
                 command=["ignis-submit"] + args,
                 environment=env,
                 mounts=[to_mount(bind) for bind in binds],